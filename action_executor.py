@@ -0,0 +1,65 @@
+import asyncio
+import concurrent.futures
+from logging import getLogger
+
+import const
+
+logger = getLogger('devel')
+
+
+class action_executor(object):
+    # Runs device action handlers (on()/off()) away from the event loop so
+    # a slow IR blaster or HTTP call can't stall discovery or the other
+    # switches. Plain functions go to a thread (or process) pool and
+    # coroutine functions are awaited directly. Calls for the same device
+    # run one at a time in the order they came in; different devices run
+    # in parallel.
+    def __init__(self, loop, max_workers=const.ACTION_WORKERS,
+                 timeout=const.ACTION_TIMEOUT, pool=const.ACTION_POOL):
+        self._loop = loop
+        self._timeout = timeout
+        if pool == 'process':
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers, thread_name_prefix='action')
+        self._locks = {}
+
+    async def run(self, key, func, *args):
+        # Returns whatever func returns, or False if it raised or didn't
+        # finish within the timeout.
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+
+        await lock.acquire()
+        if asyncio.iscoroutinefunction(func):
+            task = asyncio.ensure_future(func(*args))
+        else:
+            task = self._loop.run_in_executor(self._pool, func, *args)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task),
+                                          self._timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s timed out after %ss" %
+                           (getattr(func, '__qualname__', func),
+                            self._timeout))
+            return False
+        except Exception as e:
+            logger.error("%s failed: %s" %
+                         (getattr(func, '__qualname__', func), e))
+            return False
+        finally:
+            # A timed out handler may still be running; hold the device
+            # until it really finishes so its commands stay ordered.
+            if task.done():
+                lock.release()
+            else:
+                task.add_done_callback(lambda _: lock.release())
+
+    def forget(self, key):
+        self._locks.pop(key, None)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
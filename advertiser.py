@@ -0,0 +1,69 @@
+import asyncio
+from logging import getLogger, DEBUG
+import random
+
+import const
+from ssdp_sender import SSDP_ADDR
+
+logger = getLogger('devel')
+
+
+class advertiser(object):
+    # Re-sends every device's ssdp:alive NOTIFYs well inside the max-age we
+    # advertise, so an Echo that rebooted or missed the startup burst picks
+    # the devices up again without a search of its own. Each device runs
+    # on its own timer, started at a random point in the first period and
+    # jittered every round after that, so the fleet never announces all at
+    # once. On shutdown every device says ssdp:byebye.
+    JITTER = 0.1
+
+    def __init__(self, loop, sender, interval=const.SSDP_ADVERTISE_INTERVAL,
+                 max_age=const.SSDP_MAX_AGE):
+        self._loop = loop
+        self._sender = sender
+        self._interval = min(interval, max_age / 2.0)
+        self._timers = {}
+
+    def add(self, device):
+        if device in self._timers:
+            return
+
+        self._timers[device] = self._loop.call_later(
+            random.uniform(0, self._interval), self._alive, device)
+
+    def remove(self, device, byebye=True):
+        timer = self._timers.pop(device, None)
+        if not timer:
+            return
+
+        timer.cancel()
+        if byebye:
+            device.notify(self._sender, 'ssdp:byebye')
+
+    def _alive(self, device):
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Re-advertising %s" % device.name)
+
+        device.notify(self._sender)
+        self._timers[device] = self._loop.call_later(
+            self._interval * random.uniform(1 - self.JITTER, 1),
+            self._alive, device)
+
+    async def shutdown(self):
+        # One batch of byebyes for the whole fleet, sent before the
+        # sender's socket goes away.
+        packets = []
+        for device, timer in self._timers.items():
+            timer.cancel()
+            packets.extend((msg, SSDP_ADDR)
+                           for msg in device.notify_packets('ssdp:byebye'))
+        self._timers.clear()
+
+        if packets:
+            logger.info("Sending ssdp:byebye for all devices")
+            self._sender.send(packets)
+            try:
+                await asyncio.wait_for(self._sender.drain(),
+                                       const.SSDP_BYEBYE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Gave up waiting for byebye to be sent")
@@ -0,0 +1,131 @@
+import json
+from logging import getLogger
+import os
+import uuid
+
+import const
+from upnp_device import upnp_device
+
+logger = getLogger('devel')
+
+
+class allocation_table(object):
+    # Remembers, per device name, the port it was served on and the serial
+    # and UUID it was announced with, so after a restart each device comes
+    # back at the LOCATION the Echo already has cached and no rediscovery
+    # is needed. Entries are created the first time a name is seen and
+    # kept when a device is removed, so it gets the same ones if it comes
+    # back. Saved to ALLOCATIONS_FILE (None keeps them in memory only).
+    def __init__(self, loop, path=const.ALLOCATIONS_FILE):
+        self._loop = loop
+        self._path = path
+        self._entries = {}
+        # port -> the name holding it, and the serials handed out, so a
+        # fleet coming up isn't a scan of the table per device
+        self._ports = {}
+        self._serials = set()
+        self._save_pending = False
+
+        if self._path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self._path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.error("Ignoring unreadable %s: %s" % (self._path, e))
+            return
+
+        for name, entry in self._entries.items():
+            self._index(name, entry)
+        logger.info("Loaded allocations of %d devices from %s" %
+                    (len(self._entries), self._path))
+
+    def _index(self, name, entry):
+        self._serials.add(entry['serial'])
+        if entry['port']:
+            self._ports.setdefault(entry['port'], name)
+
+    def _unindex(self, name, entry):
+        if self._ports.get(entry['port']) == name:
+            del self._ports[entry['port']]
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            # make_uuid() is what devices always used, so keep it where it
+            # doesn't collide; it only looks at the sum and the first few
+            # characters of the name.
+            serial = upnp_device.make_uuid(name)
+            if serial in self._serials:
+                serial = uuid.uuid4().hex[:14]
+            entry = {'port': 0, 'serial': serial, 'uuid': str(uuid.uuid4())}
+            self._entries[name] = entry
+            self._index(name, entry)
+            self._changed()
+        elif entry['port'] and \
+                self._ports.get(entry['port'], name) != name:
+            # two devices on one port (the file was edited by hand)
+            logger.warning("'%s' shares port %d with another device, "
+                           "giving it a new one" % (name, entry['port']))
+            entry['port'] = 0
+            self._changed()
+
+        return entry
+
+    def entries(self, names=None):
+        if names is None:
+            names = self._entries
+        return {name: dict(self._entries[name]) for name in names
+                if name in self._entries}
+
+    def update(self, entries):
+        # Take over entries handed out elsewhere (by another process)
+        for name, entry in entries.items():
+            old = self._entries.get(name)
+            if old != entry:
+                if old:
+                    self._unindex(name, old)
+                self._entries[name] = dict(entry)
+                self._index(name, entry)
+                self._changed()
+
+    def assign(self, name, port):
+        entry = self.get(name)
+        if entry['port'] == port:
+            return
+
+        # The port is ours now; a device that isn't running had it
+        # reserved, it gets a new one when it comes back.
+        holder = self._ports.get(port)
+        if holder is not None and holder != name:
+            self._entries[holder]['port'] = 0
+        self._unindex(name, entry)
+        entry['port'] = port
+        if port:
+            self._ports[port] = name
+        self._changed()
+
+    def _changed(self):
+        # Coalesce the saves for a batch of devices brought up together
+        if self._path and not self._save_pending:
+            self._save_pending = True
+            self._loop.call_soon(self.save)
+
+    def save(self):
+        self._save_pending = False
+        temp = self._path + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+            os.replace(temp, self._path)
+        except OSError as e:
+            logger.error("Failed to save %s: %s" % (self._path, e))
+
+    def close(self):
+        if self._save_pending:
+            self.save()
+
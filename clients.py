@@ -0,0 +1,150 @@
+import collections
+import time
+
+import const
+
+
+class bucket(object):
+    # Token bucket: `rate` a second, up to `burst` saved up
+    __slots__ = ('_rate', '_burst', '_tokens', '_stamp')
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+
+class client(object):
+    # What one address has been sending us
+    __slots__ = ('address', 'searches', 'requests', 'commands', 'throttled',
+                 '_searches', '_requests', '_commands')
+
+    def __init__(self, address, table):
+        self.address = address
+        self.searches = 0
+        self.requests = 0
+        self.commands = 0
+        # 'search' / 'request' / 'command' -> how many were turned away
+        self.throttled = {}
+        self._searches = bucket(table.search_rate, table.search_burst)
+        self._requests = bucket(table.request_rate, table.request_burst)
+        self._commands = bucket(table.command_rate, table.command_burst)
+
+    def _throttle(self, kind):
+        self.throttled[kind] = self.throttled.get(kind, 0) + 1
+        return False
+
+
+class read_queue(object):
+    # Lets at most `batch` requests that aren't commands start per turn of
+    # the loop; the rest wait their turn, in order. Commands don't go
+    # through here, so one that comes in behind a flood of setup.xml or
+    # GetBinaryState is handled on the turn it's read, not after them.
+    def __init__(self, loop, batch):
+        self._loop = loop
+        self._batch = batch
+        self._started = 0
+        self._waiting = collections.deque()
+        self._turn = None
+        # reads that had to wait
+        self.deferred = 0
+
+    async def turn(self):
+        if not self._waiting and self._started < self._batch:
+            self._started += 1
+            self._next_turn()
+            return
+
+        self.deferred += 1
+        future = self._loop.create_future()
+        self._waiting.append(future)
+        self._next_turn()
+        await future
+
+    def _next_turn(self):
+        if not self._turn:
+            self._turn = self._loop.call_soon(self._release)
+
+    def _release(self):
+        self._turn = None
+        self._started = 0
+        while self._waiting and self._started < self._batch:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_result(None)
+                self._started += 1
+        if self._started:
+            self._next_turn()
+
+
+class client_table(object):
+    # Who has been sending us what, by source address, and the limits
+    # that keep one of them from crowding out the rest (see CLIENT_* in
+    # const.py). Commands have a bucket of their own and skip `reads`.
+    MAX_CLIENTS = 4096
+
+    def __init__(self, loop, search_rate=const.CLIENT_SEARCH_RATE,
+                 search_burst=const.CLIENT_SEARCH_BURST,
+                 request_rate=const.CLIENT_REQUEST_RATE,
+                 request_burst=const.CLIENT_REQUEST_BURST,
+                 command_rate=const.CLIENT_COMMAND_RATE,
+                 command_burst=const.CLIENT_COMMAND_BURST,
+                 read_batch=const.HTTP_READ_BATCH):
+        self.search_rate = search_rate
+        self.search_burst = search_burst
+        self.request_rate = request_rate
+        self.request_burst = request_burst
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.reads = read_queue(loop, read_batch)
+        self._clients = {}
+
+    def get(self, address):
+        found = self._clients.get(address)
+        if found is None:
+            if len(self._clients) >= self.MAX_CLIENTS:
+                # forget whoever we heard from first
+                del self._clients[next(iter(self._clients))]
+            found = self._clients[address] = client(address, self)
+
+        return found
+
+    def search(self, address):
+        # True if an M-SEARCH from address is to be answered
+        c = self.get(address)
+        c.searches += 1
+        return c._searches.take() or c._throttle('search')
+
+    def request(self, address):
+        # True if a request (other than a command) is to be served;
+        # requests that didn't come over the network always are
+        if address is None:
+            return True
+
+        c = self.get(address)
+        c.requests += 1
+        return c._requests.take() or c._throttle('request')
+
+    def command(self, address):
+        # True if a command is to be carried out
+        if address is None:
+            return True
+
+        c = self.get(address)
+        c.commands += 1
+        return c._commands.take() or c._throttle('command')
+
+    def __iter__(self):
+        return iter(list(self._clients.values()))
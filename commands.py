@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import const
+
+# What submit() returns for a command that was replaced before it ran: not a
+# failure, but the device is in whatever state the commands around it left
+SUPERSEDED = 'superseded'
+
+
+class command_pipeline(object):
+    # Sits between a device's SOAP actions and its action handler. A
+    # command goes to the handler straight away unless another is running;
+    # those that arrive meanwhile are sorted out before any reach it:
+    #
+    #  - the same command again while one is waiting or running (several
+    #    Echos hearing one utterance) joins it instead of running twice
+    #  - a different one waits for the running one to finish, and replaces
+    #    whichever was waiting already (on, then off again right away),
+    #    which never reaches the handler and comes back as SUPERSEDED
+    #  - a command the handler was given less than COMMAND_DEDUP_WINDOW
+    #    seconds ago is answered straight away without calling it
+    #
+    # Commands are any hashable value; equal ones are duplicates.
+    __slots__ = ('_loop', '_executor', '_key', '_window', '_applied',
+                 '_applied_at', '_pending', '_running', 'stats')
+
+    def __init__(self, loop, executor, key, stats,
+                 window=const.COMMAND_DEDUP_WINDOW):
+        self._loop = loop
+        self._executor = executor
+        self._key = key
+        self._window = window
+        # the command last handed to the handler, and when
+        self._applied = None
+        self._applied_at = 0
+        # (command, future, func, args) waiting for the running one
+        self._pending = None
+        # (command, future) being run by the handler
+        self._running = None
+        self.stats = stats
+
+    async def submit(self, command, func, *args):
+        # Returns True if the command was carried out (or didn't need to
+        # be), SUPERSEDED if another took its place before it ran, False if
+        # the handler failed.
+        if self._pending:
+            waiting, future = self._pending[:2]
+            if waiting == command:
+                self._count('collapsed')
+                return await asyncio.shield(future)
+
+            self._pending = None
+            future.set_result(SUPERSEDED)
+            self._count('cancelled')
+
+        if self._running and self._running[0] == command:
+            self._count('collapsed')
+            return await asyncio.shield(self._running[1])
+
+        if command == self._applied and \
+                time.monotonic() - self._applied_at < self._window:
+            self._count('collapsed')
+            return True
+
+        future = self._loop.create_future()
+        if self._running:
+            self._pending = (command, future, func, args)
+        else:
+            self._fire(command, func, args, future)
+        return await asyncio.shield(future)
+
+    def _fire(self, command, func, args, future):
+        self._applied = command
+        self._applied_at = time.monotonic()
+        self._running = (command, future)
+        self._count('executed')
+        task = self._loop.create_task(
+            self._executor.run(self._key, func, *args))
+        task.add_done_callback(lambda task: self._done(command, future, task))
+
+    def _done(self, command, future, task):
+        if self._running and self._running[1] is future:
+            self._running = None
+        result = not task.cancelled() and bool(task.result())
+        if not result and self._applied == command:
+            # let the next attempt through
+            self._applied = None
+        if not future.done():
+            future.set_result(result)
+        if self._pending and not self._running:
+            command, future, func, args = self._pending
+            self._pending = None
+            self._fire(command, func, args, future)
+
+    def _count(self, outcome):
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def cancel(self):
+        if self._pending:
+            self._pending[1].set_result(False)
+            self._pending = None
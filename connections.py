@@ -0,0 +1,264 @@
+import asyncio
+from logging import getLogger, DEBUG
+import math
+
+import const
+
+logger = getLogger('devel')
+
+
+class timer_wheel(object):
+    # Timeouts for a lot of connections that keep pushing their deadline
+    # out: (re)scheduling one is moving it between two sets, rather than a
+    # timer handle per connection and activity. Items expire up to a tick
+    # late, never early, and nothing runs while the wheel is empty.
+    def __init__(self, loop, tick, longest):
+        self._loop = loop
+        self._tick = tick
+        self._slots = [set() for _ in range(int(math.ceil(longest / tick))
+                                            + 2)]
+        self._now = 0
+        self._count = 0
+        self._timer = None
+
+    def schedule(self, item, timeout):
+        self.cancel(item)
+        # the current tick is partly gone
+        ticks = min(int(math.ceil(timeout / self._tick)) + 1,
+                    len(self._slots) - 1)
+        item.slot = (self._now + ticks) % len(self._slots)
+        self._slots[item.slot].add(item)
+        self._count += 1
+        if not self._timer:
+            self._timer = self._loop.call_later(self._tick, self._advance)
+
+    def cancel(self, item):
+        if item.slot is not None:
+            self._slots[item.slot].discard(item)
+            item.slot = None
+            self._count -= 1
+
+    def _advance(self):
+        self._now = (self._now + 1) % len(self._slots)
+        expired = self._slots[self._now]
+        self._slots[self._now] = set()
+        self._count -= len(expired)
+        for item in expired:
+            item.slot = None
+            item.expire()
+
+        self._timer = None
+        if self._count:
+            self._timer = self._loop.call_later(self._tick, self._advance)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+
+class connection(object):
+    # One accepted connection. http_server.serve() tells it what it's
+    # doing: waiting for a request (idle), part way through one (reading)
+    # or busy with one, which is the only state without a timeout (the
+    # action handlers have their own).
+    __slots__ = ('owner', 'number', 'peer', 'transport', 'task', 'state',
+                 'slot', '_manager')
+
+    def __init__(self, manager, owner, number, peer):
+        self._manager = manager
+        self.owner = owner
+        self.number = number
+        self.peer = peer
+        self.transport = None
+        self.task = None
+        self.state = None
+        self.slot = None
+
+    def received(self, data):
+        trace = self._manager.trace
+        if trace:
+            trace.http(self.number, self.peer, self.owner.port, data)
+
+    def idle(self):
+        self.state = 'idle'
+        self._manager.wheel.schedule(self, self._manager.idle_timeout)
+
+    def reading(self):
+        # The clock starts at the first byte of a request and isn't reset
+        # by the ones after, so a client trickling bytes can't hold on.
+        if self.state != 'reading':
+            self.state = 'reading'
+            self._manager.wheel.schedule(self, self._manager.read_timeout)
+
+    def busy(self):
+        self.state = 'busy'
+        self._manager.wheel.cancel(self)
+
+    def expire(self):
+        self._manager.expired[self.state] = \
+            self._manager.expired.get(self.state, 0) + 1
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("closing %s connection" % self.state)
+        self.close()
+
+    def close(self):
+        if self.transport:
+            self.transport.abort()
+
+
+class connection_manager(object):
+    # Accepts and keeps track of the HTTP connections of every listening
+    # socket (a device, the shared listener, the metrics endpoint): anything
+    # with a bound socket and a handle_client(reader, writer, conn)
+    # coroutine. Up to ACCEPT_BATCH connections are accepted per wakeup.
+    # With CONNECTION_MAX open in all, or CONNECTION_MAX_PER_LISTENER (or
+    # the limit it was given) on one socket, idle keep-alive connections
+    # are closed to make room for those waiting; once there are none left
+    # accepting stops, leaving newcomers in the kernel's backlog, until
+    # some are closed.
+    def __init__(self, loop, max_total=const.CONNECTION_MAX,
+                 max_per_listener=const.CONNECTION_MAX_PER_LISTENER,
+                 idle_timeout=const.CONNECTION_IDLE_TIMEOUT,
+                 read_timeout=const.CONNECTION_READ_TIMEOUT,
+                 batch=const.ACCEPT_BATCH, trace=None):
+        self._loop = loop
+        self._max_total = max_total
+        self._max_per_listener = max_per_listener
+        self._batch = batch
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        # a packet_trace.trace_recorder, if recording
+        self.trace = trace
+        self.wheel = timer_wheel(loop, 1, max(idle_timeout, read_timeout))
+        # listener -> its open connections
+        self._listeners = {}
+        self._limits = {}
+        self._paused = set()
+        self.open = 0
+        self.accepted = 0
+        self.evicted = 0
+        self.pauses = 0
+        # state -> connections closed for timing out in it
+        self.expired = {}
+
+    def listen(self, owner, limit=None):
+        # limit overrides max_per_listener, e.g. for the listener shared
+        # by all the devices
+        owner.socket.setblocking(False)
+        self._listeners[owner] = set()
+        self._limits[owner] = limit or self._max_per_listener
+        self._loop.add_reader(owner.socket.fileno(), self._accept, owner)
+
+    def unlisten(self, owner):
+        conns = self._listeners.pop(owner, None)
+        if conns is None:
+            return
+
+        del self._limits[owner]
+        if owner in self._paused:
+            self._paused.discard(owner)
+        else:
+            self._loop.remove_reader(owner.socket.fileno())
+        owner.socket.close()
+        self.open -= len(conns)
+        for conn in conns:
+            self.wheel.cancel(conn)
+            conn.close()
+        if self._paused:
+            self._resume()
+
+    def _full(self, owner):
+        return (self.open >= self._max_total or
+                len(self._listeners[owner]) >= self._limits[owner])
+
+    def _accept(self, owner):
+        for i in range(self._batch):
+            if self._full(owner):
+                # Only the first time round is someone known to be waiting
+                # (that's what woke us); if there are more we're woken again.
+                if i or not self._make_room(owner):
+                    if not i:
+                        self._pause(owner)
+                    return
+
+            try:
+                sock, address = owner.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. out of fds; try again on the next wakeup
+                logger.warning("accept failed: %s" % e)
+                return
+
+            sock.setblocking(False)
+            self.accepted += 1
+            conn = connection(self, owner, self.accepted, address)
+            self._listeners[owner].add(conn)
+            self.open += 1
+            # the loop only keeps a weak reference to the task
+            conn.task = self._loop.create_task(
+                self._serve(owner, conn, sock))
+
+    def _make_room(self, owner):
+        # Closes an idle keep-alive connection, the owner's or, if it's the
+        # global limit we're up against, anybody's. False if there's none.
+        if self.open >= self._max_total:
+            pools = self._listeners.values()
+        else:
+            pools = [self._listeners[owner]]
+        for conns in pools:
+            for conn in conns:
+                if conn.state == 'idle':
+                    conn.close()
+                    self._forget(conn)
+                    self.evicted += 1
+                    return True
+
+        return False
+
+    def _pause(self, owner):
+        if owner not in self._paused:
+            self._loop.remove_reader(owner.socket.fileno())
+            self._paused.add(owner)
+            self.pauses += 1
+            logger.warning("Too many connections, not accepting on %s:%s "
+                           "for now" % owner.socket.getsockname())
+
+    def _resume(self):
+        for owner in list(self._paused):
+            if not self._full(owner):
+                self._paused.discard(owner)
+                self._loop.add_reader(owner.socket.fileno(), self._accept,
+                                      owner)
+
+    async def _serve(self, owner, conn, sock):
+        try:
+            reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(reader)
+            conn.transport, _ = await self._loop.connect_accepted_socket(
+                lambda: protocol, sock)
+            writer = asyncio.StreamWriter(conn.transport, protocol, reader,
+                                          self._loop)
+            await owner.handle_client(reader, writer, conn)
+        except Exception as e:
+            logger.error("connection failed: %s" % e)
+            if not conn.transport:
+                sock.close()
+        finally:
+            self._forget(conn)
+            conn.close()
+
+    def _forget(self, conn):
+        self.wheel.cancel(conn)
+        conns = self._listeners.get(conn.owner)
+        if conns is not None and conn in conns:
+            conns.discard(conn)
+            self.open -= 1
+            if self._paused:
+                self._resume()
+
+    def close(self):
+        for owner in list(self._listeners):
+            self.unlisten(owner)
+        self.wheel.close()
@@ -1,8 +1,8 @@
 # This XML is the minimum needed to define one of our virtual switches
 # to the Amazon Echo
 # working with Alexa Amazon Echo (2nd generation)
-URL_SETUP_XML = "http://%(ip_address)s:%(port)s/setup.xml"
-URL_DES_XML = "http://%(ip_address)s:%(port)s/setup.xml"
+URL_SETUP_XML = "http://%(ip_address)s:%(port)s%(prefix)s/setup.xml"
+URL_DES_XML = "http://%(ip_address)s:%(port)s%(prefix)s/setup.xml"
 
 POST_UPNP = 'POST /upnp/control/basicevent1 HTTP/1.1'
 GET_EVENT_SRV_XML = 'GET /eventservice.xml HTTP/1.1'
@@ -15,5 +15,138 @@ ALEXA = {'192.168.3.9'  : 'Echo Plus',
 FILTER = [ '192.168.3.254', '192.168.3.253', '192.168.3.252', '192.168.3.251',
            '192.168.3.1', '192.168.3.12', '192.168.3.2' ]
 
+# SSDP packets from addresses (or CIDR networks) in FILTER are dropped
+# unread. If SSDP_ALLOW is a list, only senders matching it are looked at,
+# e.g. SSDP_ALLOW = list(ALEXA) or ['192.168.3.0/24'].
+SSDP_ALLOW = None
+
 UPNP_ROOT_DEVICE = 'upnp:rootdevice'
 USN_UPNP_ROOT_DEVICE = 'uuid:%s::upnp:rootdevice'
+
+# M-SEARCH replies are spread over the requester's MX window (capped at
+# SSDP_MAX_MX seconds) and repeated searches from one sender are only
+# answered once per SSDP_SEARCH_WINDOW seconds.
+SSDP_MAX_MX = 5
+SSDP_SEARCH_WINDOW = 2
+
+# Port of the single HTTP listener shared by all virtual devices; 0 picks
+# an ephemeral one. None gives every device a listening socket of its own.
+SHARED_HTTP_PORT = None
+
+# Action handlers run in a 'thread' or 'process' pool of ACTION_WORKERS
+# workers and are given up on after ACTION_TIMEOUT seconds. A 'process' pool
+# needs handlers that pickle: the built-in 'log' and 'black_bean' ones do,
+# a registered one must be a module-level class holding nothing like
+# sockets, locks or lambdas (groups' handlers are coroutines and always run
+# on the loop). A group switches up to GROUP_CONCURRENCY members at once
+# (blocking handlers are also limited by ACTION_WORKERS).
+ACTION_POOL = 'thread'
+ACTION_WORKERS = 32
+ACTION_TIMEOUT = 10
+GROUP_CONCURRENCY = 16
+
+# Outgoing SSDP datagrams are paced at SSDP_SEND_RATE a second, allowing
+# bursts of up to SSDP_SEND_BURST.
+SSDP_SEND_RATE = 200
+SSDP_SEND_BURST = 50
+
+# Devices announce themselves with max-age SSDP_MAX_AGE and re-send their
+# ssdp:alive every SSDP_ADVERTISE_INTERVAL seconds (never less often than
+# every max-age/2). The byebyes sent on shutdown get SSDP_BYEBYE_TIMEOUT
+# seconds to go out.
+SSDP_MAX_AGE = 86400
+SSDP_ADVERTISE_INTERVAL = 1800
+SSDP_BYEBYE_TIMEOUT = 2
+
+# Prometheus metrics are served at http://METRICS_ADDRESS:METRICS_PORT/metrics;
+# set METRICS_PORT to None to turn the endpoint off.
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = 9198
+
+# Devices are defined in DEVICES_FILE (JSON, YAML or TOML), which is
+# checked for changes every DEVICES_POLL_INTERVAL seconds.
+DEVICES_FILE = 'devices.json'
+DEVICES_POLL_INTERVAL = 2
+
+# Relay states are kept in STATE_FILE (None keeps them in memory only).
+# Changes are written STATE_FLUSH_DELAY seconds after they happen, so a
+# burst of toggles costs one write, and the file is compacted every
+# STATE_COMPACT_INTERVAL seconds.
+STATE_FILE = 'state.log'
+STATE_FLUSH_DELAY = 1
+STATE_COMPACT_INTERVAL = 3600
+
+# The port, serial and UUID each device was given are kept in
+# ALLOCATIONS_FILE so devices come back where the Echo expects them after
+# a restart (None keeps them in memory only).
+ALLOCATIONS_FILE = 'allocations.json'
+
+# Names or addresses of the interfaces to do SSDP on, e.g. ['eth0', 'vlan20'];
+# None uses every interface that is up and multicast capable.
+SSDP_INTERFACES = None
+
+# With SHARDS > 1 the devices are split over that many worker processes,
+# each with its own SSDP listener, sockets and event loop, under a
+# supervisor that restarts them (after SHARD_RESTART_DELAY seconds, doubling
+# while they keep failing) and serves their metrics, reported every
+# SHARD_REPORT_INTERVAL seconds, as one view.
+SHARDS = 1
+SHARD_REPORT_INTERVAL = 5
+SHARD_RESTART_DELAY = 1
+
+# GENA event subscriptions are granted for GENA_MIN_TIMEOUT to
+# GENA_MAX_TIMEOUT seconds. State changes are pushed GENA_COALESCE seconds
+# after they happen (one NOTIFY for a burst of them) over at most
+# GENA_MAX_CONNECTIONS connections at once, each given GENA_TIMEOUT seconds.
+# A subscriber whose callback fails GENA_MAX_FAILURES times in a row is
+# dropped; expired subscriptions are swept every GENA_SWEEP_INTERVAL seconds.
+GENA_MIN_TIMEOUT = 60
+GENA_MAX_TIMEOUT = 1800
+GENA_COALESCE = 0.1
+GENA_MAX_CONNECTIONS = 32
+GENA_TIMEOUT = 5
+GENA_MAX_FAILURES = 3
+GENA_SWEEP_INTERVAL = 60
+
+# A SetBinaryState the action handler was given less than
+# COMMAND_DEDUP_WINDOW seconds ago (several Echos hearing one utterance) is
+# acknowledged without calling it again.
+COMMAND_DEDUP_WINDOW = 2
+
+# HTTP connections waiting for a request are closed after
+# CONNECTION_IDLE_TIMEOUT seconds, ones that started sending a request after
+# CONNECTION_READ_TIMEOUT seconds. At most CONNECTION_MAX are kept open in
+# all and CONNECTION_MAX_PER_LISTENER per listening socket (each device's,
+# or the shared one); beyond that idle ones are closed to make room and new
+# ones wait in the kernel's backlog of CONNECTION_BACKLOG. Up to
+# ACCEPT_BATCH connections are accepted each time a socket wakes the loop.
+CONNECTION_IDLE_TIMEOUT = 60
+CONNECTION_READ_TIMEOUT = 10
+CONNECTION_MAX = 4096
+CONNECTION_MAX_PER_LISTENER = 64
+CONNECTION_BACKLOG = 128
+ACCEPT_BATCH = 32
+
+# With TRACE_RECORDS > 0 the last that many SSDP datagrams and HTTP reads are
+# kept in memory and written to TRACE_FILE on SIGUSR1 and at shutdown, for
+# trace_replay.py to play back.
+TRACE_RECORDS = 0
+TRACE_FILE = 'smart_home.trace'
+
+# Each client (by source address) has its M-SEARCHes answered at most
+# CLIENT_SEARCH_RATE times a second, CLIENT_SEARCH_BURST in a row, its HTTP
+# requests served at CLIENT_REQUEST_RATE a second, CLIENT_REQUEST_BURST in a
+# row (discovery fetches setup.xml from every device at once), and its
+# commands, the SOAP actions that change something like SetBinaryState,
+# carried out at CLIENT_COMMAND_RATE a second, CLIENT_COMMAND_BURST in a row
+# (a group or routine switches many devices at once). Beyond that searches
+# are ignored and requests answered 503. At most HTTP_READ_BATCH requests
+# other than commands are started per turn of the event loop; the rest wait
+# for the next, while commands are handled as soon as they're read.
+CLIENT_SEARCH_RATE = 1
+CLIENT_SEARCH_BURST = 20
+CLIENT_REQUEST_RATE = 100
+CLIENT_REQUEST_BURST = 1000
+CLIENT_COMMAND_RATE = 20
+CLIENT_COMMAND_BURST = 200
+HTTP_READ_BATCH = 16
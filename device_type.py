@@ -0,0 +1,334 @@
+import asyncio
+from logging import getLogger, DEBUG
+import time
+
+from commands import command_pipeline
+import gena
+from http_server import error_response
+from upnp_device import upnp_device, http_date, KEEP_ALIVE, CLOSE
+
+logger = getLogger('devel')
+
+SERVICE_XML = """        <service>
+            <serviceType>%(service_type)s</serviceType>
+            <serviceId>%(service_id)s</serviceId>
+            <controlURL>%%(url_prefix)s%(control_url)s</controlURL>
+            <eventSubURL>%%(url_prefix)s%(event_url)s</eventSubURL>
+            <SCPDURL>%%(url_prefix)s%(scpd_url)s</SCPDURL>
+        </service>
+"""
+
+SOAP_RESPONSE = \
+"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:%(action)sResponse xmlns:u="%(service_type)s">
+%(arguments)s    </u:%(action)sResponse>
+  </s:Body>
+</s:Envelope>
+"""
+
+ARGUMENT = "      <%(name)s>%%(%(name)s)s</%(name)s>\n"
+
+
+class action(object):
+    # A SOAP action of a service. Without a method it just reports the
+    # state variables in `returns`; its reply is rendered from the device's
+    # state and cached until that changes. Otherwise the device's method
+    # of that name is called with the request and the SOAPACTION, and
+    # returns the response (or a coroutine for it), normally by calling
+    # device.reply() once it has done its work.
+    __slots__ = ('method', 'returns')
+
+    def __init__(self, method=None, returns=()):
+        self.method = method
+        self.returns = tuple(returns)
+
+
+class service(object):
+    # `events` are the state variables pushed to GENA subscribers
+    __slots__ = ('service_type', 'service_id', 'control_url', 'event_url',
+                 'scpd_url', 'scpd', 'actions', 'events')
+
+    def __init__(self, service_type, service_id, control_url, event_url,
+                 scpd_url, scpd, actions, events=()):
+        self.service_type = service_type
+        self.service_id = service_id
+        self.control_url = control_url
+        self.event_url = event_url
+        self.scpd_url = scpd_url
+        self.scpd = scpd
+        self.actions = actions
+        self.events = tuple(events)
+
+
+class device_type(upnp_device):
+    # Base class for device type plugins. A plugin subclasses it and
+    # declares:
+    #
+    #   UUID_PREFIX  put in front of the device's serial for its UUID
+    #   DESCRIPTION  setup.xml, with %(device_name)s, %(device_serial)s,
+    #                %(url_prefix)s and %(service_list)s in it
+    #   SERVICES     its services, with their SCPD and actions
+    #   STATE        state variable -> initial value
+    #
+    # Everything that is the same for each device of a type - the routing
+    # table, the description with the service list filled in, the SOAP
+    # reply and event templates, and the SCPD and stateless replies - is
+    # built once, when the class is defined, and shared by all of them.
+    # A device only keeps its own state (and none until it changes) and
+    # the replies that depend on it.
+    UUID_PREFIX = 'Device-1_0-'
+    SERVER_VERSION = "OS2/4.50 UPnP/1.0 UPnP-Device-Host/1.0"
+    OTHER_HEADERS = ['X-User-Agent: Solvalou/3.14']
+    DESCRIPTION = None
+    SERVICES = ()
+    STATE = {}
+    __slots__ = ('_serial', '_values', '_commands')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.DESCRIPTION is not None:
+            cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        # (method, path, SOAPACTION) -> (request type, handler, argument,
+        # whether it's a command: an action that changes something)
+        routes = {('GET', '/setup.xml', ''):
+                  ('setup_xml', '_get_description', None, False)}
+        # SOAPACTION -> (reply template, whether it depends on the state)
+        templates = {}
+        # service -> GENA propertyset template
+        events = {}
+        service_list = []
+        for s in cls.SERVICES:
+            service_list.append(SERVICE_XML % {
+                'service_type': s.service_type, 'service_id': s.service_id,
+                'control_url': s.control_url, 'event_url': s.event_url,
+                'scpd_url': s.scpd_url})
+            routes[('GET', s.scpd_url, '')] = (
+                s.scpd_url.strip('/').replace('.', '_'), '_get_scpd', s,
+                False)
+            routes[('SUBSCRIBE', s.event_url, '')] = ('subscribe',
+                                                      '_subscribe', s, False)
+            routes[('UNSUBSCRIBE', s.event_url, '')] = (
+                'unsubscribe', '_unsubscribe', s, False)
+            events[s] = gena.event_template(s.events)
+
+            for name, a in s.actions.items():
+                soap_action = '%s#%s' % (s.service_type, name)
+                templates[soap_action] = (SOAP_RESPONSE % {
+                    'action': name, 'service_type': s.service_type,
+                    'arguments': ''.join(ARGUMENT % {'name': argument}
+                                         for argument in a.returns)},
+                    bool(a.returns))
+                routes[('POST', s.control_url, soap_action)] = (
+                    name, a.method or 'reply', soap_action, bool(a.method))
+
+        cls.ROUTES = routes
+        cls.TEMPLATES = templates
+        cls.EVENTS = events
+        cls.STATEFUL = tuple(key for key, (_, stateful) in templates.items()
+                             if stateful)
+        cls._description = cls.DESCRIPTION.replace('%(service_list)s',
+                                                   ''.join(service_list))
+        cls._shared = {}
+
+    def __init__(self, name, listener, runtime, ip_address, port):
+        # created on the first command
+        self._commands = None
+        # same serial, UUID and (unless one is configured) port as last time
+        allocation = runtime.allocations.get(name)
+        self._serial = allocation['serial']
+
+        allocated = not port and not runtime.http_server
+        if allocated:
+            port = allocation['port']
+        while True:
+            try:
+                upnp_device.__init__(self, listener, runtime, port,
+                                     self.SERVER_VERSION,
+                                     self.UUID_PREFIX + self._serial,
+                                     other_headers=self.OTHER_HEADERS,
+                                     ip_address=ip_address,
+                                     device_uuid=allocation['uuid'])
+                break
+            except OSError as e:
+                if not allocated or not port:
+                    raise
+                # Someone else has our old port. The Echo's cached LOCATION
+                # is stale either way; the alive NOTIFY for the new port
+                # puts it right.
+                logger.warning("Port %d of '%s' is taken (%s), moving it" %
+                               (port, name, e))
+                port = 0
+        if allocated:
+            runtime.allocations.assign(name, self.port)
+        self.name = name
+
+        # pick up where we left off before a restart
+        saved = runtime.state.get(name, None)
+        if isinstance(saved, dict):
+            self._values = dict(self.STATE)
+            self._values.update((key, value) for key, value in saved.items()
+                                if key in self.STATE)
+        elif saved is not None and self.STATE:
+            # older state files kept just a switch's BinaryState
+            self._values = dict(self.STATE)
+            self._values[next(iter(self.STATE))] = saved
+        else:
+            self._values = self.STATE
+
+    async def command(self, command, func, *args):
+        # Hands func(*args) to the action handler through the device's
+        # command pipeline, which collapses repeated commands; see
+        # command_pipeline.submit() for what comes back
+        if self._commands is None:
+            self._commands = command_pipeline(self._runtime.loop,
+                                              self._runtime.executor, self,
+                                              self.metrics.commands)
+        return await self._commands.submit(command, func, *args)
+
+    def stop(self):
+        if self._commands:
+            self._commands.cancel()
+        upnp_device.stop(self)
+
+    def get(self, variable):
+        return self._values[variable]
+
+    def set(self, variable, value):
+        if self._values[variable] == value:
+            return
+
+        if self._values is self.STATE:
+            self._values = dict(self.STATE)
+        self._values[variable] = value
+        self._runtime.state.set(self.name, dict(self._values))
+        for key in self.STATEFUL:
+            self.invalidate(key)
+        self._runtime.events.publish(self, variable)
+
+    @property
+    def last_changed(self):
+        # time.time() of the last state change, None if it never changed
+        return self._runtime.state.changed(self.name)
+
+    def reply(self, request, soap_action):
+        # The action's reply, filled in from the current state
+        template, stateful = self.TEMPLATES[soap_action]
+        if stateful:
+            return self.cached_response(soap_action,
+                                        lambda: template % self._values,
+                                        request.keep_alive)
+
+        return self.cached_response((soap_action, self.extra_headers),
+                                    lambda: template, request.keep_alive,
+                                    cache=self._shared)
+
+    def _get_description(self, request, argument):
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Responding to setup.xml for %s" % self._name)
+        return self.cached_response(
+            'setup.xml',
+            lambda: self._description % {'device_name': self._name,
+                                         'device_serial': self._serial,
+                                         'url_prefix': self.url_prefix},
+            request.keep_alive)
+
+    def _get_scpd(self, request, s):
+        return self.cached_response((s.scpd_url, self.extra_headers),
+                                    lambda: s.scpd, request.keep_alive,
+                                    cache=self._shared)
+
+    def event_body(self, s):
+        return (self.EVENTS[s] % self._values).encode('utf-8')
+
+    def _subscribe(self, request, s):
+        # A new subscription has CALLBACK and NT, a renewal just the SID
+        headers = request.headers
+        events = self._runtime.events
+        timeout = gena.parse_timeout(headers.get('timeout'))
+        sid = headers.get('sid')
+        if sid:
+            if 'callback' in headers or 'nt' in headers:
+                return error_response(400, request.keep_alive)
+            if not events.renew(sid, self, timeout):
+                return error_response(412, request.keep_alive)
+        else:
+            callback = gena.parse_callback(headers.get('callback'))
+            if headers.get('nt') != 'upnp:event' or not callback:
+                return error_response(412, request.keep_alive)
+            sid = events.subscribe(self, s, callback, timeout)
+
+        return b''.join((("HTTP/1.1 200 OK\r\n"
+                          "CONTENT-LENGTH: 0\r\n"
+                          "SID: %s\r\n"
+                          "TIMEOUT: Second-%d\r\n"
+                          "SERVER: %s\r\n"
+                          "DATE: " % (sid, timeout, self._server_version)
+                          ).encode('ascii'), http_date(), b"\r\n",
+                         KEEP_ALIVE if request.keep_alive else CLOSE))
+
+    def _unsubscribe(self, request, s):
+        sid = request.headers.get('sid')
+        if not sid or not self._runtime.events.unsubscribe(sid, self):
+            return error_response(412, request.keep_alive)
+
+        return error_response(200, request.keep_alive)
+
+    def nt_usn(self):
+        header_nt_usn = upnp_device.nt_usn(self)
+        for s in self.SERVICES:
+            header_nt_usn.append(
+                (s.service_type, 'uuid:{0}::{1}'.format(self._persistent_uuid,
+                                                        s.service_type)))
+        return header_nt_usn
+
+    async def handle_req(self, request, writer):
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('----- Start ----')
+            logger.debug("request : {0}".format(request))
+
+        route = self.ROUTES.get((request.method, request.path,
+                                 request.soap_action))
+        if not route:
+            self.metrics.count('unknown')
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Uknown request: {0}'.format(request))
+                logger.debug('---- End ----')
+            writer.write(error_response(404, request.keep_alive))
+            return
+
+        request_type, handler, argument, command = route
+        self.metrics.count(request_type)
+        clients = self._runtime.clients
+        if command:
+            allowed = clients.command(request.client)
+        else:
+            allowed = clients.request(request.client)
+        if not allowed:
+            self.metrics.count('throttled')
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('too many requests from %s' % request.client)
+            writer.write(error_response(503, request.keep_alive))
+            return
+
+        if not command:
+            await clients.reads.turn()
+        await self._respond(request, writer, handler, argument)
+
+    async def _respond(self, request, writer, handler, argument):
+        start = time.perf_counter()
+        msg = getattr(self, handler)(request, argument)
+        if asyncio.iscoroutine(msg):
+            msg = await msg
+        sent = time.perf_counter()
+        self.metrics.handler.observe(sent - start)
+        writer.write(msg)
+        await writer.drain()
+        self.metrics.send.observe(time.perf_counter() - sent)
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(msg)
+            logger.debug('---- End ----')
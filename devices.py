@@ -1,6 +1,273 @@
-import smart_switch
+import json
+from logging import getLogger
+import os
+import zlib
 
-def load(listener, poller):
-    smart_switch.load(listener, poller)
+import const
+from dimmer import dimmer
+from group import group
+from smart_switch import smart_switch, action_to_black_bean, log_handler
+from ssdp_sender import SSDP_ADDR
 
-    smart_switch.notify(listener.ssock)
+logger = getLogger('devel')
+
+# handler type in the device file -> factory called with its args
+HANDLERS = {
+    'black_bean': action_to_black_bean,
+    'log': log_handler,
+}
+
+
+# device type in the device file -> device_type plugin class
+TYPES = {
+    'switch': smart_switch,
+    'dimmer': dimmer,
+    'group': group,
+}
+
+
+def register_handler(name, factory):
+    HANDLERS[name] = factory
+
+
+def register_type(name, cls):
+    TYPES[name] = cls
+
+
+def read_file(path):
+    # The device file is JSON, YAML or TOML, picked by extension, holding a
+    # list of devices:
+    #
+    #   {"devices": [{"name": "kitchen lights", "port": 49153,
+    #                 "handler": "black_bean",
+    #                 "args": ["cmd=on&a=kitchen", "cmd=off&a=kitchen"]}]}
+    #
+    # Only name is required; type defaults to 'switch', port to 0 (dynamic)
+    # and handler to 'log'. A 'group' has a list of "members" instead of a
+    # handler: the names of the (non group) devices it switches.
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("%s: YAML device files need PyYAML "
+                             "(pip install pyyaml)" % path)
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    elif extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("%s: TOML device files need Python 3.11+ "
+                             "(tomllib)" % path)
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(path) as f:
+            config = json.load(f)
+
+    specs = {}
+    for entry in (config or {}).get('devices', []):
+        name = entry['name']
+        if name in specs:
+            raise ValueError("device '%s' is defined twice" % name)
+
+        handler = entry.get('handler', 'log')
+        if handler not in HANDLERS:
+            raise ValueError("device '%s' has unknown handler type '%s'" %
+                             (name, handler))
+
+        device_type = entry.get('type', 'switch')
+        if device_type not in TYPES:
+            raise ValueError("device '%s' has unknown type '%s'" %
+                             (name, device_type))
+
+        members = list(entry.get('members', []))
+        if (device_type == 'group') != bool(members):
+            raise ValueError("device '%s': only groups have members, and "
+                             "they need some" % name)
+
+        args = entry.get('args', [])
+        specs[name] = {'name': name,
+                       'type': device_type,
+                       'port': int(entry.get('port', 0)),
+                       'handler': handler,
+                       'args': args,
+                       'members': members}
+
+    for spec in specs.values():
+        for member in spec['members']:
+            if member not in specs:
+                raise ValueError("group '%s' has unknown member '%s'" %
+                                 (spec['name'], member))
+            if specs[member]['members']:
+                raise ValueError("group '%s' can't have group '%s' as a "
+                                 "member" % (spec['name'], member))
+
+    return specs
+
+
+def shard_of(name, count):
+    # Stable across runs and processes, unlike hash()
+    return zlib.crc32(name.encode('utf-8')) % count
+
+
+def shards(specs, count):
+    # name -> shard. A group's members go to the group's shard, since it
+    # can only switch devices in its own process; a device in several
+    # groups goes with the first.
+    owner = {}
+    for spec in specs.values():
+        for member in spec['members']:
+            owner.setdefault(member, spec['name'])
+
+    return {name: shard_of(owner.get(name, name), count) for name in specs}
+
+
+def make_handler(spec):
+    factory = HANDLERS[spec['handler']]
+    args = spec['args']
+    if isinstance(args, dict):
+        return factory(**args)
+
+    return factory(*args)
+
+
+def notify(sender, switches, nts='ssdp:alive'):
+    # Build the NOTIFYs for every switch in one pass and hand them to the
+    # sender as a single batch; the second round repeats the first.
+    packets = [(msg, SSDP_ADDR)
+               for switch in switches for msg in switch.notify_packets(nts)]
+    if packets:
+        sender.send(packets * 2)
+
+
+class device_registry(object):
+    # Owns the running switches and keeps them in step with the device
+    # file. Reloads are applied as a diff: devices that didn't change keep
+    # serving untouched, a changed handler is swapped in place, and only
+    # devices that were added, removed or moved to another port are torn
+    # down or brought up (with byebye / alive for just those).
+    #
+    # A registry given a shard, (index, count), only runs the devices that
+    # shards() puts in its slice of the file.
+    def __init__(self, listener, runtime, path=const.DEVICES_FILE,
+                 interval=const.DEVICES_POLL_INTERVAL, shard=None):
+        self._listener = listener
+        self._runtime = runtime
+        self._path = path
+        self._interval = interval
+        self._mtime = None
+        self._specs = {}
+        self._timer = None
+        self._shard = shard
+        # the runtime's device table, which devices join when created
+        self.switches = runtime.devices.by_name
+
+    def read(self):
+        specs = read_file(self._path)
+        if self._shard:
+            index, count = self._shard
+            placement = shards(specs, count)
+            specs = {name: spec for name, spec in specs.items()
+                     if placement[name] == index}
+
+        return specs
+
+    def load(self):
+        self._mtime = os.stat(self._path).st_mtime
+        self.apply(self.read())
+
+    def apply(self, specs):
+        added = []
+        for name in list(self.switches):
+            if name not in specs:
+                self._remove(name)
+                self._runtime.state.forget(name)
+
+        for name, spec in specs.items():
+            old = self._specs.get(name)
+            if old == spec:
+                continue
+
+            if old and old['port'] == spec['port'] and \
+                    old['type'] == spec['type']:
+                logger.info("Updating handler of '%s'" % name)
+                switch = self.switches[name]
+                if spec['members']:
+                    switch.set_members(spec['members'])
+                else:
+                    switch.action_handler = make_handler(spec)
+                self._specs[name] = spec
+                continue
+
+            port = spec['port']
+            if old:
+                # moved to another port (or back to a dynamic one), or
+                # changed type; a dynamic port is kept if we had one
+                if not port:
+                    port = self.switches[name].port
+                self._remove(name)
+
+            switch = self._add(spec, port)
+            if switch:
+                added.append(switch)
+                self._specs[name] = spec
+
+        notify(self._runtime.ssdp, added)
+
+    def _add(self, spec, port):
+        try:
+            if spec['members']:
+                switch = group(spec['name'], self._listener, self._runtime,
+                               None, port, members=spec['members'],
+                               lookup=self.switches.get)
+            else:
+                switch = TYPES[spec['type']](
+                    spec['name'], self._listener, self._runtime, None, port,
+                    action_handler=make_handler(spec))
+        except OSError as e:
+            logger.error("Failed to start '%s' on port %s: %s" %
+                         (spec['name'], port, e))
+            return None
+
+        logger.info("Added '%s'" % spec['name'])
+        return switch
+
+    def _remove(self, name):
+        switch = self.switches.get(name)
+        self._specs.pop(name, None)
+        if switch:
+            logger.info("Removing '%s'" % name)
+            switch.stop()
+
+    def watch(self):
+        # No inotify in the standard library; polling the mtime every few
+        # seconds is cheap and good enough for a file edited by hand.
+        self._timer = self._runtime.loop.call_later(self._interval,
+                                                    self._check)
+
+    def _check(self):
+        try:
+            mtime = os.stat(self._path).st_mtime
+            if mtime != self._mtime:
+                self._mtime = mtime
+                logger.info("%s changed, reloading" % self._path)
+                self.apply(self.read())
+        except Exception as e:
+            logger.error("Failed to reload %s, keeping current devices: %s" %
+                         (self._path, e))
+        finally:
+            self.watch()
+
+
+def load(listener, runtime, shard=None):
+    registry = device_registry(listener, runtime, shard=shard)
+    try:
+        registry.load()
+    except Exception as e:
+        logger.error("Failed to load %s: %s" % (const.DEVICES_FILE, e))
+        return None
+
+    registry.watch()
+    return registry
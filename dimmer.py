@@ -0,0 +1,61 @@
+from logging import getLogger
+import re
+
+from commands import SUPERSEDED
+from device_type import action, service
+from http_server import error_response
+from smart_switch import SETUP_XML, SERVICE, CONTROL_URL, eventservice_xml
+from smart_switch import smart_switch
+
+logger = getLogger('devel')
+
+# An example device type plugin: a WeMo style dimmer. It is a switch with
+# a brightness (1-100) that SetBinaryState may carry along with the state
+# and GetBinaryState reports back.
+
+DIMMER_SETUP_XML = SETUP_XML \
+    .replace('Emulated Light', 'Emulated Dimmer') \
+    .replace('uuid:Light-1_0-', 'uuid:Dimmer-1_0-') \
+    .replace('urn:Belkin:device:controllee:1', 'urn:Belkin:device:dimmer:1')
+
+DIMMER_EVENT_XML = eventservice_xml.replace(
+    '<name>level</name>', '<name>brightness</name>')
+
+BRIGHTNESS_RE = re.compile(r'<brightness>(\d+)</brightness>')
+
+
+class dimmer(smart_switch):
+    UUID_PREFIX = 'Dimmer-1_0-'
+    DESCRIPTION = DIMMER_SETUP_XML
+    SERVICES = (service(SERVICE, 'urn:Belkin:serviceId:basicevent1',
+                        CONTROL_URL, '/upnp/event/basicevent1',
+                        '/eventservice.xml', DIMMER_EVENT_XML,
+                        {'GetBinaryState': action(
+                            returns=('BinaryState', 'brightness')),
+                         'SetBinaryState': action('_soap_set_binary_state')},
+                        events=('BinaryState', 'brightness')),)
+    STATE = {'BinaryState': 0, 'brightness': 100}
+    __slots__ = ()
+
+    # The action handler may have a dim(level) as well as on() and off();
+    # without one a brightness is only remembered.
+    async def _soap_set_binary_state(self, request, soap_action):
+        match = BRIGHTNESS_RE.search(request.body)
+        if not match:
+            return await smart_switch._soap_set_binary_state(self, request,
+                                                             soap_action)
+
+        level = max(1, min(int(match.group(1)), 100))
+        logger.info("Responding to brightness %d for %s" % (level, self._name))
+        dim = getattr(self.action_handler, 'dim', None)
+        if dim:
+            result = await self.command(('dim', level), dim, level)
+        else:
+            result = await self.command(1, self.action_handler.on)
+        if not result:
+            return error_response(500, request.keep_alive)
+
+        if result is not SUPERSEDED:
+            self.set('brightness', level)
+            self.state = 1
+        return self.reply(request, soap_action)
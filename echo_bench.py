@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+# Load generator for the virtual switches. It starts a smart_home runtime
+# with a fleet of no-op switches in a child process and then plays a
+# number of stand-in Echos against it, each replaying the exchange from
+# protocol_notes.txt:
+#
+#   M-SEARCH -> wait for every device's reply -> GET setup.xml for each
+#   -> a burst of SetBinaryState commands (like a routine firing)
+#
+# and reports discovery time, per-request latency and requests/sec, e.g.
+#
+#   ./echo_bench.py --devices 100 --echos 4 --commands 20 --concurrency 20
+#
+# Everything runs over the local interface; the SSDP listener still needs
+# to be able to bind port 1900 and join the multicast group.
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import random
+import re
+import sys
+import time
+
+SSDP_ADDR = ('239.255.255.250', 1900)
+
+M_SEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'MAN: "ssdp:discover"\r\n'
+            'MX: %d\r\n'
+            'ST: upnp:rootdevice\r\n'
+            '\r\n')
+
+SET_BINARY_STATE = ('POST %s/upnp/control/basicevent1 HTTP/1.1\r\n'
+                    'Host: %s:%d\r\n'
+                    'Accept: */*\r\n'
+                    'Content-type: text/xml; charset="utf-8"\r\n'
+                    'SOAPACTION: "urn:Belkin:service:basicevent:1'
+                    '#SetBinaryState"\r\n'
+                    'Content-Length: %d\r\n'
+                    'Connection: close\r\n'
+                    '\r\n'
+                    '%s')
+
+SET_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+            's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+            '<s:Body><u:SetBinaryState '
+            'xmlns:u="urn:Belkin:service:basicevent:1">'
+            '<BinaryState>%d</BinaryState>'
+            '</u:SetBinaryState></s:Body></s:Envelope>')
+
+GET_SETUP_XML = ('GET %s/setup.xml HTTP/1.1\r\n'
+                 'Host: %s:%d\r\n'
+                 'Accept: */*\r\n'
+                 'Connection: close\r\n'
+                 '\r\n')
+
+LOCATION_RE = re.compile(r'^LOCATION:\s*http://([^:/]+):(\d+)(/[^\r\n]*)?'
+                         r'/setup\.xml', re.IGNORECASE | re.MULTILINE)
+
+
+class null_handler(object):
+    def on(self):
+        return True
+
+    def off(self):
+        return True
+
+
+def device_name(index):
+    return 'bench %d' % index
+
+
+def serve(count, shared, ip_address, pipe):
+    # Child process: a runtime with `count` switches and no-op handlers
+    logging.basicConfig(level=logging.WARNING)
+    from clients import client_table
+    from upnp_handler import runtime, upnp_broadcaster
+    from smart_switch import smart_switch
+
+    listener = upnp_broadcaster()
+    if not listener.init_socket():
+        pipe.send(None)
+        return
+
+    rt = runtime(state_file=None, allocations_file=None)
+    # the simulated Echos all come from the one address
+    rt.clients = client_table(rt.loop, search_burst=math.inf,
+                              request_burst=math.inf, command_burst=math.inf)
+    rt.add_listener(listener)
+    if shared:
+        rt.share_http(ip_address, 0)
+
+    switches = [smart_switch(device_name(i), listener, rt, ip_address,
+                             0, action_handler=null_handler())
+                for i in range(count)]
+    pipe.send([(s.ip_address, s.port, s.url_prefix) for s in switches])
+    rt.run()
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class search_protocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait(data.decode('utf-8', 'replace'))
+
+
+class echo(object):
+    # One stand-in Echo, keeping its own timings
+    def __init__(self, name, args, expected):
+        self.name = name
+        self._args = args
+        self._expected = expected
+        self.discovery = None
+        self.latency = {'setup_xml': [], 'SetBinaryState': []}
+        self.errors = 0
+
+    async def discover(self):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            search_protocol, local_addr=('0.0.0.0', 0))
+        found = set()
+        start = time.perf_counter()
+        deadline = start + self._args.mx + self._args.timeout
+        try:
+            transport.sendto((M_SEARCH % self._args.mx).encode('ascii'),
+                             SSDP_ADDR)
+            while found != self._expected:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    reply = await asyncio.wait_for(protocol.replies.get(),
+                                                   remaining)
+                except asyncio.TimeoutError:
+                    break
+                match = LOCATION_RE.search(reply)
+                if match:
+                    location = (match.group(1), int(match.group(2)),
+                                match.group(3) or '')
+                    if location in self._expected:
+                        found.add(location)
+        finally:
+            transport.close()
+
+        if found == self._expected:
+            self.discovery = time.perf_counter() - start
+        else:
+            self.errors += len(self._expected - found)
+
+        return found
+
+    async def request(self, kind, host, port, raw):
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), self._args.timeout)
+            writer.write(raw.encode('utf-8'))
+            status = await asyncio.wait_for(reader.readline(),
+                                            self._args.timeout)
+            await asyncio.wait_for(reader.read(), self._args.timeout)
+            writer.close()
+        except (OSError, asyncio.TimeoutError):
+            self.errors += 1
+            return
+
+        if b' 200 ' not in status:
+            self.errors += 1
+            return
+
+        self.latency[kind].append(time.perf_counter() - start)
+
+    async def run(self):
+        devices = sorted(await self.discover())
+        if not devices:
+            return
+
+        for host, port, prefix in devices:
+            await self.request('setup_xml', host, port,
+                               GET_SETUP_XML % (prefix, host, port))
+
+        # the routine: `commands` SetBinaryStates, `concurrency` at a time
+        limit = asyncio.Semaphore(self._args.concurrency)
+
+        async def command():
+            host, port, prefix = random.choice(devices)
+            body = SET_BODY % random.randint(0, 1)
+            async with limit:
+                await self.request('SetBinaryState', host, port,
+                                   SET_BINARY_STATE % (prefix, host, port,
+                                                       len(body), body))
+
+        await asyncio.gather(*[command()
+                               for _ in range(self._args.commands)])
+
+
+async def run_echos(args, expected):
+    echos = [echo('echo %d' % i, args, expected) for i in range(args.echos)]
+    start = time.perf_counter()
+    await asyncio.gather(*[e.run() for e in echos])
+    return echos, time.perf_counter() - start
+
+
+def report(args, echos, elapsed):
+    discovery = [e.discovery for e in echos if e.discovery is not None]
+    result = {'devices': args.devices, 'echos': args.echos,
+              'shared_http': args.shared,
+              'discovery_p50': percentile(discovery, 50),
+              'discovery_p99': percentile(discovery, 99),
+              'errors': sum(e.errors for e in echos),
+              'elapsed': elapsed}
+
+    requests = 0
+    for kind in ('setup_xml', 'SetBinaryState'):
+        latency = [l for e in echos for l in e.latency[kind]]
+        requests += len(latency)
+        result[kind + '_p50'] = percentile(latency, 50)
+        result[kind + '_p99'] = percentile(latency, 99)
+        result[kind + '_count'] = len(latency)
+    result['requests_per_sec'] = requests / elapsed if elapsed else 0
+
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+
+    print("devices %d, echos %d, shared http %s" %
+          (args.devices, args.echos, args.shared))
+    print("%-16s %10s %10s %8s" % ('', 'p50 ms', 'p99 ms', 'count'))
+    print("%-16s %10.1f %10.1f %8d" % ('discovery',
+                                       result['discovery_p50'] * 1000,
+                                       result['discovery_p99'] * 1000,
+                                       len(discovery)))
+    for kind in ('setup_xml', 'SetBinaryState'):
+        print("%-16s %10.2f %10.2f %8d" % (kind,
+                                           result[kind + '_p50'] * 1000,
+                                           result[kind + '_p99'] * 1000,
+                                           result[kind + '_count']))
+    print("%.0f requests/sec, %d errors, %.2fs total" %
+          (result['requests_per_sec'], result['errors'], elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark smart_home against simulated Echos')
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--echos', type=int, default=2)
+    parser.add_argument('--commands', type=int, default=20,
+                        help='SetBinaryState calls per Echo')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='SetBinaryState calls in flight per Echo')
+    parser.add_argument('--mx', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--shared', action='store_true',
+                        help='serve all devices from one HTTP listener')
+    parser.add_argument('--ip', default=None,
+                        help='address the devices bind to')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    if not args.ip:
+        from upnp_device import upnp_device
+        args.ip = upnp_device.local_ip()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(
+        args.devices, args.shared, args.ip, child), daemon=True)
+    server.start()
+    devices = parent.recv()
+    if devices is None:
+        print("could not start the SSDP listener", file=sys.stderr)
+        return 1
+
+    try:
+        # give the child's loop a moment to start serving
+        time.sleep(0.2)
+        echos, elapsed = asyncio.run(run_echos(args, set(devices)))
+        report(args, echos, elapsed)
+    finally:
+        server.terminate()
+        server.join()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import asyncio
+from logging import getLogger, DEBUG
+import re
+import time
+import uuid
+
+import const
+
+logger = getLogger('devel')
+
+CALLBACK_RE = re.compile(r'<http://([^:/>]+)(?::(\d+))?([^>]*)>')
+TIMEOUT_RE = re.compile(r'Second-(\d+)', re.IGNORECASE)
+
+PROPERTY_SET = ('<?xml version="1.0"?>\n'
+                '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">\n'
+                '%s'
+                '</e:propertyset>\n')
+PROPERTY = '<e:property>\n<%(name)s>%%(%(name)s)s</%(name)s>\n</e:property>\n'
+
+EVENT_NOTIFY = ("NOTIFY %(path)s HTTP/1.1\r\n"
+                "HOST: %(host)s:%(port)d\r\n"
+                "CONTENT-TYPE: text/xml; charset=\"utf-8\"\r\n"
+                "NT: upnp:event\r\n"
+                "NTS: upnp:propchange\r\n"
+                "SID: %(sid)s\r\n"
+                "SEQ: %(seq)d\r\n"
+                "CONTENT-LENGTH: %(length)d\r\n"
+                "\r\n")
+
+
+def event_template(variables):
+    # propertyset body for the variables, with %(name)s placeholders
+    return PROPERTY_SET % ''.join(PROPERTY % {'name': name}
+                                  for name in variables)
+
+
+def parse_callback(value):
+    # The first http:// URL of a CALLBACK header, as (host, port, path)
+    match = CALLBACK_RE.search(value or '')
+    if not match:
+        return None
+
+    return (match.group(1), int(match.group(2) or 80),
+            match.group(3) or '/')
+
+
+def parse_timeout(value, maximum=const.GENA_MAX_TIMEOUT):
+    match = TIMEOUT_RE.search(value or '')
+    if not match:
+        # missing, or 'infinite', which we don't grant
+        return maximum
+
+    return max(const.GENA_MIN_TIMEOUT, min(int(match.group(1)), maximum))
+
+
+class subscription(object):
+    __slots__ = ('sid', 'device', 'service', 'callback', 'expires', 'seq',
+                 'sending', 'failures')
+
+    def __init__(self, sid, device, service, callback, expires):
+        self.sid = sid
+        self.device = device
+        self.service = service
+        self.callback = callback
+        self.expires = expires
+        self.seq = 0
+        self.sending = False
+        self.failures = 0
+
+
+class connection_pool(object):
+    # Outbound HTTP/1.1 connections to the subscribers' callbacks, kept
+    # open between events and reused, with at most GENA_MAX_CONNECTIONS
+    # requests in flight at once.
+    MAX_IDLE = 2
+
+    def __init__(self, limit=const.GENA_MAX_CONNECTIONS,
+                 timeout=const.GENA_TIMEOUT):
+        self._limit = asyncio.Semaphore(limit)
+        self._timeout = timeout
+        self._idle = {}
+
+    async def request(self, host, port, data):
+        # Returns the response status, or None if there wasn't one
+        async with self._limit:
+            idle = self._idle.get((host, port))
+            if idle:
+                # the callback may have closed it meanwhile; try a fresh
+                # connection if so
+                status = await self._exchange(host, port, data, idle.pop())
+                if status is not None:
+                    return status
+
+            return await self._exchange(host, port, data, None)
+
+    async def _exchange(self, host, port, data, conn):
+        try:
+            if conn is None:
+                conn = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self._timeout)
+            reader, writer = conn
+            writer.write(data)
+            status, keep_alive = await asyncio.wait_for(
+                self._response(reader), self._timeout)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as e:
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("event to %s:%d failed: %s" % (host, port, e))
+            if conn is not None:
+                conn[1].close()
+            return None
+
+        idle = self._idle.setdefault((host, port), [])
+        if keep_alive and len(idle) < self.MAX_IDLE:
+            idle.append(conn)
+        else:
+            writer.close()
+
+        return status
+
+    @staticmethod
+    async def _response(reader):
+        head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        lines = head.split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if length:
+            await reader.readexactly(length)
+
+        return status, headers.get('connection', '').lower() != 'close'
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class event_publisher(object):
+    # The GENA subscription table and the sending of events. A state
+    # change only marks the device's subscriptions dirty; GENA_COALESCE
+    # seconds later each dirty one gets a single NOTIFY with the state as
+    # it is by then, however many changes came in between, and a
+    # subscriber never has more than one NOTIFY in flight. Expired
+    # subscriptions are swept every GENA_SWEEP_INTERVAL seconds, and ones
+    # whose callback failed GENA_MAX_FAILURES times in a row are dropped.
+    def __init__(self, loop, delay=const.GENA_COALESCE,
+                 sweep=const.GENA_SWEEP_INTERVAL):
+        self._loop = loop
+        self._delay = delay
+        self._sweep_interval = sweep
+        self._pool = connection_pool()
+        self._subscriptions = {}
+        self._by_device = {}
+        self._dirty = set()
+        self._timer = None
+        self._sweep_timer = None
+        self.sent = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, device, service, callback, timeout):
+        sid = 'uuid:%s' % uuid.uuid4()
+        sub = subscription(sid, device, service, callback,
+                           time.monotonic() + timeout)
+        self._subscriptions[sid] = sub
+        self._by_device.setdefault(device, set()).add(sub)
+        if not self._sweep_timer:
+            self._sweep_timer = self._loop.call_later(self._sweep_interval,
+                                                      self._sweep)
+        logger.info("%s subscribed to '%s' as %s" %
+                    (callback[0], device.name, sid))
+
+        # the initial event, with every evented variable
+        self._mark(sub)
+        return sid
+
+    def renew(self, sid, device, timeout):
+        sub = self._subscriptions.get(sid)
+        if not sub or sub.device is not device:
+            return False
+
+        sub.expires = time.monotonic() + timeout
+        return True
+
+    def unsubscribe(self, sid, device):
+        sub = self._subscriptions.get(sid)
+        if not sub or sub.device is not device:
+            return False
+
+        self._drop(sub)
+        return True
+
+    def publish(self, device, variable):
+        for sub in self._by_device.get(device, ()):
+            if variable in sub.service.events:
+                self._mark(sub)
+
+    def forget(self, device):
+        for sub in list(self._by_device.get(device, ())):
+            self._drop(sub)
+
+    def _drop(self, sub):
+        self._subscriptions.pop(sub.sid, None)
+        self._dirty.discard(sub)
+        subs = self._by_device.get(sub.device)
+        if subs:
+            subs.discard(sub)
+            if not subs:
+                del self._by_device[sub.device]
+
+    def _mark(self, sub):
+        self._dirty.add(sub)
+        if not self._timer:
+            self._timer = self._loop.call_later(self._delay, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        now = time.monotonic()
+        pending, self._dirty = self._dirty, set()
+        bodies = {}
+        for sub in pending:
+            if sub.expires < now:
+                self._drop(sub)
+                continue
+            if sub.sending:
+                # goes out once the one in flight is done
+                self._dirty.add(sub)
+                continue
+
+            key = (sub.device, sub.service)
+            body = bodies.get(key)
+            if body is None:
+                body = bodies[key] = sub.device.event_body(sub.service)
+            self._loop.create_task(self._send(sub, body))
+
+    async def _send(self, sub, body):
+        sub.sending = True
+        host, port, path = sub.callback
+        head = EVENT_NOTIFY % {'path': path, 'host': host, 'port': port,
+                               'sid': sub.sid, 'seq': sub.seq,
+                               'length': len(body)}
+        # SEQ wraps to 1, 0 being the initial event's
+        sub.seq = sub.seq + 1 if sub.seq < 0xffffffff else 1
+        try:
+            status = await self._pool.request(host, port,
+                                              head.encode('ascii') + body)
+        finally:
+            sub.sending = False
+
+        if status == 200:
+            self.sent += 1
+            sub.failures = 0
+        else:
+            self.failed += 1
+            sub.failures += 1
+            if sub.failures >= const.GENA_MAX_FAILURES or status == 412:
+                logger.warning("Dropping subscription %s to '%s'" %
+                               (sub.sid, sub.device.name))
+                self._drop(sub)
+                return
+
+        if sub in self._dirty and not self._timer:
+            self._timer = self._loop.call_later(self._delay, self._flush)
+
+    def _sweep(self):
+        now = time.monotonic()
+        for sub in list(self._subscriptions.values()):
+            if sub.expires < now:
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug("subscription %s expired" % sub.sid)
+                self._drop(sub)
+
+        self._sweep_timer = None
+        if self._subscriptions:
+            self._sweep_timer = self._loop.call_later(self._sweep_interval,
+                                                      self._sweep)
+
+    def close(self):
+        for timer in (self._timer, self._sweep_timer):
+            if timer:
+                timer.cancel()
+        self._timer = self._sweep_timer = None
+        self._pool.close()
@@ -0,0 +1,81 @@
+import asyncio
+from logging import getLogger
+
+from commands import SUPERSEDED
+import const
+from smart_switch import smart_switch
+
+logger = getLogger('devel')
+
+
+class fan_out(object):
+    # The action handler of a group: turns every member on or off through
+    # the member's own command pipeline and handler, GROUP_CONCURRENCY of
+    # them at a time, so a scene takes about as long as its slowest
+    # member rather than the sum of them all. The pipeline adds no delay
+    # to an idle member; it's there so a member's own commands, before or
+    # after the group's, are deduplicated against what the group did.
+    def __init__(self, group, members, lookup, limit=const.GROUP_CONCURRENCY):
+        self._group = group
+        self._members = members
+        self._lookup = lookup
+        self._limit = limit
+
+    async def on(self):
+        return await self._switch(1)
+
+    async def off(self):
+        return await self._switch(0)
+
+    async def _switch(self, state):
+        limit = asyncio.Semaphore(self._limit)
+
+        async def switch(name):
+            member = self._lookup(name)
+            if member is None:
+                logger.warning("Group '%s' has no member '%s'" %
+                               (self._group.name, name))
+                return False
+
+            async with limit:
+                handler = member.action_handler
+                result = await member.command(
+                    state, handler.on if state else handler.off)
+            if not result:
+                return False
+
+            if result is not SUPERSEDED:
+                member.state = state
+            return True
+
+        results = await asyncio.gather(*[switch(name)
+                                         for name in self._members])
+        failed = [name for name, ok in zip(self._members, results) if not ok]
+        self._group.failed = failed
+        if not failed:
+            return True
+
+        logger.warning("Group '%s': %d of %d members failed: %s" %
+                       (self._group.name, len(failed), len(self._members),
+                        ', '.join(failed)))
+        self._group.metrics.commands['partial'] = \
+            self._group.metrics.commands.get('partial', 0) + 1
+        # the Echo gets an error only if nothing at all worked
+        return len(failed) < len(self._members)
+
+
+class group(smart_switch):
+    # A switch standing for several devices of this process, e.g. a scene
+    # or "everything". `failed` lists the members the last command didn't
+    # work for.
+    __slots__ = ('failed', '_lookup')
+
+    def __init__(self, name, listener, runtime, ip_address, port,
+                 members=(), lookup=None):
+        self.failed = []
+        smart_switch.__init__(self, name, listener, runtime, ip_address, port)
+        self._lookup = lookup
+        self.set_members(members)
+
+    def set_members(self, members):
+        self.action_handler = fan_out(self, list(members), self._lookup)
@@ -0,0 +1,234 @@
+from logging import getLogger, DEBUG
+import socket
+import time
+
+import const
+import interfaces
+
+logger = getLogger('devel')
+
+# Anything bigger than this without a blank line is not an Echo talking
+MAX_HEADER_SIZE = 8192
+MAX_BODY_SIZE = 65536
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+          412: 'Precondition Failed', 500: 'Internal Server Error',
+          503: 'Service Unavailable'}
+
+
+def error_response(status, keep_alive=False):
+    return ("HTTP/1.1 %d %s\r\n"
+            "CONTENT-LENGTH: 0\r\n"
+            "CONNECTION: %s\r\n"
+            "\r\n" % (status, STATUS[status],
+                      'keep-alive' if keep_alive else 'close')).encode('ascii')
+
+
+class http_request(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # address of the client that sent it, None if it didn't come over
+        # the network
+        self.client = None
+
+    @property
+    def soap_action(self):
+        return self.headers.get('soapaction', '').strip('"')
+
+    @property
+    def keep_alive(self):
+        # HTTP/1.1 connections persist unless the client says otherwise,
+        # HTTP/1.0 ones only when it asks for it.
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+    def __str__(self):
+        return '%s %s %s %s %s' % (self.method, self.path, self.version,
+                                   self.headers, self.body)
+
+
+class request_parser(object):
+    # Incremental parser for one connection. Bytes are fed in as they
+    # arrive and complete requests come out once the header block and
+    # CONTENT-LENGTH bytes of body are in, however the client split them
+    # across TCP segments. Pipelined requests come out one after another.
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._head = None
+
+    @property
+    def pending(self):
+        # part of a request is in
+        return bool(self._buffer) or self._head is not None
+
+    def feed(self, data):
+        self._buffer += data
+        requests = []
+        while True:
+            request = self._next()
+            if request is None:
+                return requests
+            requests.append(request)
+
+    def _next(self):
+        if self._head is None:
+            end = self._buffer.find(b'\r\n\r\n', self._scanned)
+            if end == -1:
+                if len(self._buffer) > MAX_HEADER_SIZE:
+                    raise ValueError('request header too large')
+                # the terminator may straddle the next segment
+                self._scanned = max(0, len(self._buffer) - 3)
+                return None
+
+            self._head = self._parse_head(bytes(self._buffer[:end]))
+            del self._buffer[:end + 4]
+            self._scanned = 0
+
+        method, path, version, headers = self._head
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+            raise ValueError('negative content length')
+        if length > MAX_BODY_SIZE:
+            raise ValueError('request body too large')
+        if len(self._buffer) < length:
+            return None
+
+        body = bytes(self._buffer[:length]).decode('utf-8', 'replace')
+        del self._buffer[:length]
+        self._head = None
+        return http_request(method, path, version, headers, body)
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise ValueError('malformed request line: %r' % lines[0])
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        return parts[0], parts[1], parts[2], headers
+
+
+async def serve(reader, writer, handle_req, stats=None, conn=None):
+    # One coroutine per accepted connection; it sleeps in read()
+    # until the client sends something or hangs up, and keeps the
+    # connection open for as long as the client wants it, or, given the
+    # connections.connection, until it times out idle or mid-request.
+    parser = request_parser()
+    peer = writer.get_extra_info('peername')
+    client = peer[0] if peer else None
+    if stats:
+        stats.accepts += 1
+    try:
+        if conn:
+            conn.idle()
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            if conn:
+                conn.received(data)
+
+            try:
+                start = time.perf_counter()
+                requests = parser.feed(data)
+                if stats:
+                    stats.parse.observe(time.perf_counter() - start)
+            except ValueError as e:
+                logger.warning('Bad request: %s' % e)
+                writer.write(error_response(400))
+                break
+
+            keep_alive = True
+            if conn and requests:
+                conn.busy()
+            for request in requests:
+                request.client = client
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug('----- Start ----')
+                await handle_req(request, writer)
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug('---- End ----')
+                if not request.keep_alive:
+                    keep_alive = False
+                    break
+
+            if not keep_alive:
+                # CONNECTION: close, so close it once the reply is out
+                await writer.drain()
+                break
+
+            if conn:
+                if parser.pending:
+                    conn.reading()
+                else:
+                    conn.idle()
+    except ConnectionError as e:
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(e)
+    finally:
+        writer.close()
+
+
+class shared_http_server(object):
+    # A single listening socket serving every virtual device. Each device
+    # owns a path prefix ('/<persistent uuid>') which is put in front of
+    # every URL it advertises; requests are routed on that prefix and
+    # handed to the device with the prefix stripped, so the devices
+    # themselves can't tell the difference.
+    def __init__(self, ip_address='', port=0, stats=None):
+        self._devices = {}
+        self._stats = stats
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((ip_address, port))
+        self._socket.listen(const.CONNECTION_BACKLOG)
+        # no address: listen everywhere, like a device would
+        self.any_address = not ip_address
+        self.ip_address = ip_address or interfaces.table().primary
+        self.port = self._socket.getsockname()[1]
+        logger.info("Shared HTTP server listening on %s:%s" %
+                    (self.ip_address, self.port))
+
+    @property
+    def socket(self):
+        return self._socket
+
+    def add(self, device):
+        self._devices[device.url_prefix] = device
+
+    def remove(self, device):
+        self._devices.pop(device.url_prefix, None)
+
+    async def handle_client(self, reader, writer, conn=None):
+        await serve(reader, writer, self.handle_req, self._stats, conn)
+
+    async def handle_req(self, request, writer):
+        # path is '/<prefix>/<rest>'
+        end = request.path.find('/', 1)
+        device = None
+        if end != -1:
+            device = self._devices.get(request.path[:end])
+
+        if not device:
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('No device for request: {0}'.format(request))
+            writer.write(error_response(404, request.keep_alive))
+            return
+
+        request.path = request.path[end:]
+        await device.handle_req(request, writer)
@@ -0,0 +1,127 @@
+import collections
+import ipaddress
+from logging import getLogger
+import socket
+import struct
+import sys
+
+import const
+
+logger = getLogger('devel')
+
+# ioctls and interface flags from <linux/sockios.h> and <net/if.h>
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_MULTICAST = 0x1000
+
+interface = collections.namedtuple('interface', 'name address network')
+
+
+def _ioctl(sock, request, name):
+    import fcntl
+    return fcntl.ioctl(sock.fileno(), request,
+                       struct.pack('256s', name.encode('ascii')[:15]))
+
+
+def _linux_interfaces():
+    found = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            try:
+                flags = struct.unpack_from('H', _ioctl(sock, SIOCGIFFLAGS,
+                                                       name), 16)[0]
+                if not flags & IFF_UP or flags & IFF_LOOPBACK or \
+                        not flags & IFF_MULTICAST:
+                    continue
+                address = socket.inet_ntoa(
+                    _ioctl(sock, SIOCGIFADDR, name)[20:24])
+                netmask = socket.inet_ntoa(
+                    _ioctl(sock, SIOCGIFNETMASK, name)[20:24])
+            except OSError:
+                # no IPv4 address on this one
+                continue
+            found.append(interface(name, address, ipaddress.ip_network(
+                '%s/%s' % (address, netmask), strict=False)))
+    finally:
+        sock.close()
+
+    return found
+
+
+def _hostname_interfaces():
+    # Without the ioctls all we have is what the host name resolves to,
+    # and no netmask.
+    try:
+        addresses = socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        return []
+
+    return [interface(address, address, ipaddress.ip_network(address))
+            for address in addresses if not address.startswith('127.')]
+
+
+def enumerate_interfaces():
+    # The IPv4 interfaces we can do SSDP on, found without sending
+    # anything anywhere. SSDP_INTERFACES, if set, narrows them down by
+    # name or address.
+    if sys.platform.startswith('linux'):
+        found = _linux_interfaces()
+    else:
+        found = _hostname_interfaces()
+
+    if const.SSDP_INTERFACES:
+        found = [i for i in found if i.name in const.SSDP_INTERFACES or
+                 i.address in const.SSDP_INTERFACES]
+
+    return found
+
+
+class interface_table(object):
+    # Which of our addresses a peer should be given: the one on the
+    # interface whose subnet it's in, or the primary address (the first
+    # interface) for peers behind a router. Looked up for every M-SEARCH,
+    # so the answer is remembered per peer.
+    MAX_CACHED = 4096
+
+    def __init__(self, found=None):
+        self.interfaces = enumerate_interfaces() if found is None else found
+        self._cache = {}
+        if self.interfaces:
+            self.primary = self.interfaces[0].address
+        else:
+            self.primary = '127.0.0.1'
+            logger.warning("No usable network interfaces, using %s" %
+                           self.primary)
+
+    def address_for(self, ip):
+        address = self._cache.get(ip)
+        if address is None:
+            peer = ipaddress.ip_address(ip)
+            address = self.primary
+            for i in self.interfaces:
+                if peer in i.network:
+                    address = i.address
+                    break
+            if len(self._cache) >= self.MAX_CACHED:
+                self._cache.clear()
+            self._cache[ip] = address
+
+        return address
+
+
+_table = None
+
+
+def table():
+    # enumerated once, the first time anyone asks
+    global _table
+    if _table is None:
+        _table = interface_table()
+        logger.info("Network interfaces: %s" % ', '.join(
+            '%s %s' % (i.name, i.network) for i in _table.interfaces))
+
+    return _table
@@ -0,0 +1,266 @@
+import bisect
+import collections
+from logging import getLogger
+import socket
+
+import const
+import http_server
+
+logger = getLogger('devel')
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class histogram(object):
+    # Fixed buckets, allocated up front; observe() is a bisect and three
+    # additions, so it's cheap enough to leave on everywhere.
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class endpoint_metrics(object):
+    # Everything we count for one HTTP endpoint: a device, or the shared
+    # listener (which only ever sees accepts and parsing).
+    __slots__ = ('name', 'accepts', 'requests', 'commands', 'parse',
+                 'handler', 'send')
+
+    def __init__(self, name):
+        self.name = name
+        self.accepts = 0
+        self.requests = {}
+        # command pipeline outcome -> count
+        self.commands = {}
+        self.parse = histogram()
+        self.handler = histogram()
+        self.send = histogram()
+
+    def count(self, request_type):
+        self.requests[request_type] = self.requests.get(request_type, 0) + 1
+
+
+class registry(object):
+    def __init__(self):
+        self._endpoints = {}
+
+    def add(self, key, name):
+        stats = endpoint_metrics(name)
+        self._endpoints[key] = stats
+        return stats
+
+    def remove(self, key):
+        self._endpoints.pop(key, None)
+
+    def endpoints(self):
+        return list(self._endpoints.values())
+
+
+REGISTRY = registry()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _histogram(lines, name, labels, hist):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, hist.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' %
+                     (name, labels, bound, cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, hist.count))
+    lines.append('%s_sum{%s} %f' % (name, labels, hist.total))
+    lines.append('%s_count{%s} %d' % (name, labels, hist.count))
+
+
+def render(runtime):
+    # Prometheus text exposition format. All the formatting happens here,
+    # at scrape time, never on the paths being measured.
+    lines = []
+    listeners = runtime.listeners
+
+    lines.append('# TYPE smart_home_ssdp_packets_received_total counter')
+    lines.append('smart_home_ssdp_packets_received_total %d' %
+                 sum(listener.received for listener in listeners))
+
+    lines.append('# TYPE smart_home_ssdp_packets_dropped_total counter')
+    for listener in listeners:
+        for source, count in listener.dropped.items():
+            lines.append('smart_home_ssdp_packets_dropped_total'
+                         '{source="%s"} %d' % (_label(source), count))
+
+    lines.append('# TYPE smart_home_ssdp_searches_answered_total counter')
+    lines.append('smart_home_ssdp_searches_answered_total %d' %
+                 sum(listener.scheduler.answered for listener in listeners
+                     if listener.scheduler))
+    lines.append('# TYPE smart_home_ssdp_searches_coalesced_total counter')
+    lines.append('smart_home_ssdp_searches_coalesced_total %d' %
+                 sum(listener.scheduler.coalesced for listener in listeners
+                     if listener.scheduler))
+
+    lines.append('# TYPE smart_home_ssdp_datagrams_sent_total counter')
+    lines.append('smart_home_ssdp_datagrams_sent_total %d' %
+                 runtime.ssdp.sent)
+    lines.append('# TYPE smart_home_ssdp_send_syscalls_total counter')
+    lines.append('smart_home_ssdp_send_syscalls_total %d' %
+                 runtime.ssdp.syscalls)
+
+    lines.append('# TYPE smart_home_gena_subscriptions gauge')
+    lines.append('smart_home_gena_subscriptions %d' % len(runtime.events))
+    lines.append('# TYPE smart_home_gena_events_sent_total counter')
+    lines.append('smart_home_gena_events_sent_total %d' % runtime.events.sent)
+    lines.append('# TYPE smart_home_gena_events_failed_total counter')
+    lines.append('smart_home_gena_events_failed_total %d' %
+                 runtime.events.failed)
+
+    if runtime.startup:
+        lines.append('# TYPE smart_home_startup_seconds gauge')
+        for phase, seconds in runtime.startup.timings:
+            lines.append('smart_home_startup_seconds{phase="%s"} %f' %
+                         (phase, seconds))
+
+    connections = runtime.connections
+    lines.append('# TYPE smart_home_tcp_connections gauge')
+    lines.append('smart_home_tcp_connections %d' % connections.open)
+    lines.append('# TYPE smart_home_tcp_connections_timed_out_total counter')
+    for state, count in sorted(connections.expired.items()):
+        lines.append('smart_home_tcp_connections_timed_out_total'
+                     '{state="%s"} %d' % (state, count))
+    lines.append('# TYPE smart_home_tcp_connections_evicted_total counter')
+    lines.append('smart_home_tcp_connections_evicted_total %d' %
+                 connections.evicted)
+    lines.append('# TYPE smart_home_tcp_accept_pauses_total counter')
+    lines.append('smart_home_tcp_accept_pauses_total %d' % connections.pauses)
+
+    # who's generating the traffic, by name if it's one of the Echos
+    clients = []
+    for c in runtime.clients:
+        labels = 'client="%s"' % _label(c.address)
+        if c.address in const.ALEXA:
+            labels += ',name="%s"' % _label(const.ALEXA[c.address])
+        clients.append((labels, c))
+    lines.append('# TYPE smart_home_client_searches_total counter')
+    for labels, c in clients:
+        lines.append('smart_home_client_searches_total{%s} %d' %
+                     (labels, c.searches))
+    lines.append('# TYPE smart_home_client_requests_total counter')
+    for labels, c in clients:
+        lines.append('smart_home_client_requests_total{%s,priority="command"}'
+                     ' %d' % (labels, c.commands))
+        lines.append('smart_home_client_requests_total{%s,priority="read"}'
+                     ' %d' % (labels, c.requests))
+    lines.append('# TYPE smart_home_client_throttled_total counter')
+    for labels, c in clients:
+        for kind, count in sorted(c.throttled.items()):
+            lines.append('smart_home_client_throttled_total{%s,kind="%s"} %d'
+                         % (labels, kind, count))
+    lines.append('# TYPE smart_home_http_reads_deferred_total counter')
+    lines.append('smart_home_http_reads_deferred_total %d' %
+                 runtime.clients.reads.deferred)
+
+    endpoints = REGISTRY.endpoints()
+    lines.append('# TYPE smart_home_tcp_accepts_total counter')
+    for stats in endpoints:
+        lines.append('smart_home_tcp_accepts_total{device="%s"} %d' %
+                     (_label(stats.name), stats.accepts))
+
+    lines.append('# TYPE smart_home_http_requests_total counter')
+    for stats in endpoints:
+        for request_type, count in sorted(stats.requests.items()):
+            lines.append('smart_home_http_requests_total'
+                         '{device="%s",type="%s"} %d' %
+                         (_label(stats.name), request_type, count))
+
+    lines.append('# TYPE smart_home_commands_total counter')
+    for stats in endpoints:
+        for outcome, count in sorted(stats.commands.items()):
+            lines.append('smart_home_commands_total'
+                         '{device="%s",outcome="%s"} %d' %
+                         (_label(stats.name), outcome, count))
+
+    lines.append('# TYPE smart_home_request_seconds histogram')
+    for stats in endpoints:
+        for phase in ('parse', 'handler', 'send'):
+            hist = getattr(stats, phase)
+            if hist.count:
+                _histogram(lines, 'smart_home_request_seconds',
+                           'device="%s",phase="%s"' %
+                           (_label(stats.name), phase), hist)
+
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def merge(texts):
+    # Combines the output of render() from several processes, given as
+    # (shard, text) pairs, into one exposition: each sample gets a shard
+    # label and the samples of a metric family are kept together under
+    # a single TYPE line.
+    families = collections.OrderedDict()
+    for shard, text in texts:
+        label = 'shard="%s"' % _label(shard)
+        samples = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                samples = families.setdefault(line, [])
+            elif line and samples is not None:
+                name, space, value = line.rpartition(' ')
+                if name.endswith('}'):
+                    name = name.replace('{', '{%s,' % label, 1)
+                else:
+                    name = '%s{%s}' % (name, label)
+                samples.append(name + space + value)
+
+    lines = []
+    for type_line, samples in families.items():
+        lines.append(type_line)
+        lines.extend(samples)
+
+    return lines
+
+
+class metrics_server(object):
+    # Serves GET /metrics on a local port for Prometheus to scrape
+    def __init__(self, runtime, ip_address=const.METRICS_ADDRESS,
+                 port=const.METRICS_PORT, render=render):
+        self._runtime = runtime
+        self._render = render
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((ip_address, port))
+        self._socket.listen(5)
+        self.port = self._socket.getsockname()[1]
+        logger.info("Serving metrics on http://%s:%s/metrics" %
+                    (ip_address, self.port))
+
+    @property
+    def socket(self):
+        return self._socket
+
+    async def handle_client(self, reader, writer, conn=None):
+        await http_server.serve(reader, writer, self.handle_req, conn=conn)
+
+    async def handle_req(self, request, writer):
+        if request.method != 'GET' or request.path != '/metrics':
+            writer.write(http_server.error_response(404, request.keep_alive))
+            return
+
+        body = self._render(self._runtime).encode('utf-8')
+        writer.write(("HTTP/1.1 200 OK\r\n"
+                      "CONTENT-LENGTH: %d\r\n"
+                      "CONTENT-TYPE: text/plain; version=0.0.4\r\n"
+                      "CONNECTION: %s\r\n"
+                      "\r\n" % (len(body), 'keep-alive' if request.keep_alive
+                                else 'close')).encode('ascii') + body)
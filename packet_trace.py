@@ -0,0 +1,76 @@
+import collections
+from logging import getLogger
+import os
+import socket
+import struct
+import time
+
+import const
+
+logger = getLogger('devel')
+
+# A trace file is MAGIC followed by records, each a RECORD header (time,
+# kind, peer address and port, our port, connection number, length) and
+# that many bytes of payload: an SSDP datagram or what one read() of an
+# HTTP connection returned.
+MAGIC = b'SMHTRC01'
+RECORD = struct.Struct('<dB4sHHII')
+
+SSDP = 1
+HTTP = 2
+
+
+class trace_recorder(object):
+    # Keeps the last `size` SSDP datagrams and HTTP reads seen by the
+    # listener and the devices, for save() to write out (on SIGUSR1 and at
+    # shutdown) and trace_replay.py to play back. Recording one is a
+    # tuple appended to a bounded deque, the oldest falling off the other
+    # end; nothing is packed or written until a trace is asked for.
+    def __init__(self, path=const.TRACE_FILE, size=const.TRACE_RECORDS):
+        self._path = path
+        self._ring = collections.deque(maxlen=size)
+        self.recorded = 0
+
+    def datagram(self, data, sender, port):
+        self._ring.append((time.time(), SSDP, sender, port, 0, data))
+        self.recorded += 1
+
+    def http(self, number, peer, port, data):
+        self._ring.append((time.time(), HTTP, peer, port, number, data))
+        self.recorded += 1
+
+    def save(self, path=None):
+        path = path or self._path
+        records = list(self._ring)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for stamp, kind, peer, port, number, data in records:
+                f.write(RECORD.pack(stamp, kind, socket.inet_aton(peer[0]),
+                                    peer[1], port, number, len(data)))
+                f.write(data)
+        os.replace(tmp, path)
+        logger.info("Wrote %d trace records to %s" % (len(records), path))
+        return len(records)
+
+
+def read(path):
+    # Yields the records of a trace as (time, kind, (ip, port), our port,
+    # connection number, payload)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a trace file' % path)
+
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+
+            stamp, kind, ip, peer_port, port, number, length = \
+                RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError('%s is truncated' % path)
+
+            yield (stamp, kind, (socket.inet_ntoa(ip), peer_port), port,
+                   number, data)
@@ -0,0 +1,233 @@
+import asyncio
+from logging import getLogger
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from allocations import allocation_table
+import const
+import devices
+import metrics
+import startup
+
+logger = getLogger('devel')
+
+
+def shard_path(path, index):
+    # state.log -> state.2.log, so shards never write the same file
+    if not path:
+        return path
+
+    root, extension = os.path.splitext(path)
+    return '%s.%d%s' % (root, index, extension)
+
+
+def worker(index, count, entries, conn):
+    # Runs in its own process: an ordinary runtime with its own SSDP
+    # listener (the multicast group delivers every search to each of them)
+    # serving the shard's slice of the device file.
+    phases = startup.phases()
+    from upnp_handler import runtime, upnp_broadcaster
+    phases.done('imports')
+
+    listener = upnp_broadcaster()
+    if not listener.init_socket():
+        sys.exit(1)
+    phases.done('ssdp listener')
+
+    rt = runtime(state_file=shard_path(const.STATE_FILE, index),
+                 allocations_file=None,
+                 trace_file=shard_path(const.TRACE_FILE, index))
+    rt.startup = phases
+    rt.allocations.update(entries)
+    rt.add_listener(listener)
+    if const.SHARED_HTTP_PORT is not None:
+        rt.share_http('', const.SHARED_HTTP_PORT + index
+                      if const.SHARED_HTTP_PORT else 0)
+    phases.done('runtime')
+
+    registry = devices.load(listener, rt, shard=(index, count))
+    if not registry:
+        sys.exit(1)
+    phases.done('devices')
+
+    def report():
+        try:
+            conn.send({'devices': len(registry.switches),
+                       'allocations': rt.allocations.entries(
+                           registry.switches),
+                       'metrics': metrics.render(rt)})
+        except OSError:
+            # the supervisor is gone
+            rt.loop.stop()
+            return
+        rt.loop.call_later(const.SHARD_REPORT_INTERVAL, report)
+
+    rt.loop.call_soon(report)
+    rt.run()
+
+
+class shard(object):
+    # The supervisor's view of one worker
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.report = None
+        self.reported = None
+        self.restarts = 0
+        self.failures = 0
+
+
+class supervisor(object):
+    # Splits the devices over `count` worker processes so discovery bursts
+    # and requests are spread over every core. Devices are assigned by
+    # devices.shards(), so each one stays on the same shard (and its
+    # state file) from run to run. The supervisor owns the allocation
+    # table, hands each worker the entries for its devices and takes back
+    # what they changed; workers that die are restarted.
+    def __init__(self, count, loop=None):
+        if not loop:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+        self.loop = loop
+        self.count = count
+        self.shards = [shard(i) for i in range(count)]
+        self.allocations = allocation_table(loop)
+        self._context = multiprocessing.get_context('spawn')
+        self._servers = []
+        self._placement = {}
+        self._stopping = False
+
+    def serve_metrics(self, ip_address, port):
+        server = metrics.metrics_server(self, ip_address, port, render=render)
+        self.loop.create_task(self._start_server(server))
+
+    async def _start_server(self, server):
+        self._servers.append(await asyncio.start_server(
+            server.handle_client, sock=server.socket))
+
+    def start(self):
+        try:
+            specs = devices.read_file(const.DEVICES_FILE)
+        except Exception as e:
+            logger.error("Failed to load %s: %s" % (const.DEVICES_FILE, e))
+            return False
+
+        # Hand out serials and UUIDs here, where every device is in view,
+        # so no two shards pick the same one.
+        for name in specs:
+            self.allocations.get(name)
+        self._placement = devices.shards(specs, self.count)
+
+        for s in self.shards:
+            self._spawn(s)
+
+        return True
+
+    def _spawn(self, s):
+        names = [name for name, index in self._placement.items()
+                 if index == s.index]
+        s.conn, child = self._context.Pipe()
+        s.process = self._context.Process(
+            target=worker, name='shard %d' % s.index,
+            args=(s.index, self.count, self.allocations.entries(names),
+                  child))
+        s.process.start()
+        child.close()
+        logger.info("Started shard %d (pid %d)" % (s.index, s.process.pid))
+
+        self.loop.add_reader(s.conn.fileno(), self._receive, s)
+        self.loop.add_reader(s.process.sentinel, self._exited, s)
+
+    def _receive(self, s):
+        try:
+            report = s.conn.recv()
+        except (EOFError, OSError):
+            self.loop.remove_reader(s.conn.fileno())
+            return
+
+        s.report = report
+        s.reported = time.monotonic()
+        s.failures = 0
+        self.allocations.update(report['allocations'])
+
+    def _exited(self, s):
+        self.loop.remove_reader(s.process.sentinel)
+        try:
+            self.loop.remove_reader(s.conn.fileno())
+        except (OSError, ValueError):
+            pass
+        s.conn.close()
+        s.process.join()
+        s.report = None
+        if self._stopping:
+            return
+
+        s.restarts += 1
+        s.failures += 1
+        delay = min(const.SHARD_RESTART_DELAY * 2 ** (s.failures - 1), 60)
+        logger.error("Shard %d exited with %s, restarting in %ds" %
+                     (s.index, s.process.exitcode, delay))
+        self.loop.call_later(delay, self._spawn, s)
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.loop.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("Shutting down shards")
+            self._stopping = True
+            # SIGTERM lets each worker send its byebyes
+            for s in self.shards:
+                if s.process and s.process.is_alive():
+                    s.process.terminate()
+            for s in self.shards:
+                if s.process:
+                    s.process.join(const.SSDP_BYEBYE_TIMEOUT + 1)
+                    if s.process.is_alive():
+                        s.process.kill()
+            for server in self._servers:
+                server.close()
+            self.allocations.close()
+            self.loop.close()
+
+
+def render(supervisor):
+    now = time.monotonic()
+    lines = ['# TYPE smart_home_shard_up gauge']
+    for s in supervisor.shards:
+        lines.append('smart_home_shard_up{shard="%d"} %d' %
+                     (s.index, s.process is not None and
+                      s.process.is_alive() and s.report is not None))
+
+    lines.append('# TYPE smart_home_shard_restarts_total counter')
+    for s in supervisor.shards:
+        lines.append('smart_home_shard_restarts_total{shard="%d"} %d' %
+                     (s.index, s.restarts))
+
+    reporting = [s for s in supervisor.shards if s.report]
+    lines.append('# TYPE smart_home_shard_devices gauge')
+    for s in reporting:
+        lines.append('smart_home_shard_devices{shard="%d"} %d' %
+                     (s.index, s.report['devices']))
+
+    lines.append('# TYPE smart_home_shard_report_age_seconds gauge')
+    for s in reporting:
+        lines.append('smart_home_shard_report_age_seconds{shard="%d"} %f' %
+                     (s.index, now - s.reported))
+
+    lines.extend(metrics.merge([(s.index, s.report['metrics'])
+                                for s in reporting]))
+    lines.append('')
+    return '\n'.join(lines)
@@ -25,44 +25,68 @@ THE SOFTWARE.
 """
 
 # For a complete discussion, see http://www.makermusings.com
+import time
+# before anything else is imported, so the imports are timed too
+started = time.perf_counter()
+
 import logging
 from logging import config
 from logging import getLogger
 import sys
-import time
 
 import const
 import devices
-from upnp_handler import poller, upnp_broadcaster
+import shards
+import startup
+from upnp_handler import runtime, upnp_broadcaster
 
 logging.config.fileConfig('logging.conf')
 logger = getLogger()
 
 if __name__ == '__main__':
     #logging.config.fileConfig('logging.conf')
+    phases = startup.phases(started)
+    phases.done('imports')
+    
+    # Optionally split the devices over several worker processes
+    if const.SHARDS > 1:
+        s = shards.supervisor(const.SHARDS)
+        if const.METRICS_PORT is not None:
+            s.serve_metrics(const.METRICS_ADDRESS, const.METRICS_PORT)
+        if not s.start():
+            exit(-1)
+        s.run()
+        exit(0)
     
     # Set up our singleton listener for UPnP broadcasts
     u = upnp_broadcaster()
     if not u.init_socket():
         logger.error("failed to initialize broad caster")
         exit(-1)
+    phases.done('ssdp listener')
     
-    # Set up our singleton for polling the sockets for data ready
-    p = poller()
+    # Set up our singleton event loop that drives every socket
+    rt = runtime()
+    rt.startup = phases
     
-    # Add the UPnP broadcast listener to the poller so we can respond
+    # Add the UPnP broadcast listener to the runtime so we can respond
     # when a broadcast is received.
-    p.add(u)
+    rt.add_listener(u)
+    
+    # Optionally serve every device from one HTTP listener
+    if const.SHARED_HTTP_PORT is not None:
+        rt.share_http('', const.SHARED_HTTP_PORT)
+    
+    # Local Prometheus endpoint
+    if const.METRICS_PORT is not None:
+        rt.serve_metrics(const.METRICS_ADDRESS, const.METRICS_PORT)
+    phases.done('runtime')
     
     # Create our virtual switch(socket) devices
-    devices.load(u, p)
+    if not devices.load(u, rt):
+        exit(-1)
+    phases.done('devices')
     logger.info("Entering main loop\n")
     
-    while True:
-        try:
-            # Allow time for a ctrl-c to stop the process
-            p.poll(100)
-            time.sleep(0.1)
-        except Exception as e:
-            logging.error(e)
-            break
+    # Runs until ctrl-c
+    rt.run()
@@ -1,9 +1,8 @@
-import email.utils
 from logging import getLogger, DEBUG
-import socket
-from upnp_device import upnp_device
 
-import const
+from commands import SUPERSEDED
+from device_type import action, device_type, service
+from http_server import error_response
 
 logger = getLogger('devel')
 
@@ -25,14 +24,7 @@ SETUP_XML = """<?xml version="1.0"?>
     <binaryState>0</binaryState>
     <!-- service info : begin -->
     <serviceList>
-        <service>
-            <serviceType>urn:Belkin:service:basicevent:1</serviceType>
-            <serviceId>urn:Belkin:serviceId:basicevent1</serviceId>
-            <controlURL>/upnp/control/basicevent1</controlURL>
-            <eventSubURL>/upnp/event/basicevent1</eventSubURL>
-            <SCPDURL>/eventservice.xml</SCPDURL>
-        </service>
-        <!-- declaration for the other services (if any) go here -->
+%(service_list)s        <!-- declaration for the other services (if any) go here -->
     </serviceList>
     <!-- service info : end -->
     <!-- deviceList>Description of embedded devices (if any) go here </deviceList -->
@@ -68,143 +60,76 @@ eventservice_xml = """<?scpd xmlns="urn:Belkin:service-1-0"?>
 </scpd>
 """
 
-GetBinaryState_soap = \
-"""<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
-s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-  <s:Body>
-    <u:GetBinaryStateResponse xmlns:u="urn:Belkin:service:basicevent:1">
-      <BinaryState>%(state_realy)s</BinaryState>
-    </u:GetBinaryStateResponse>
-  </s:Body>
-</s:Envelope>
-"""
+SERVICE = 'urn:Belkin:service:basicevent:1'
 
-REQ_GET_BINARY_STATE = 'urn:Belkin:service:basicevent:1#GetBinaryState'
-SOAP_SET_BINARY_STATE = \
-        'SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"'
+CONTROL_URL = '/upnp/control/basicevent1'
 
-SERVICE ='urn:Belkin:service:basicevent:1'
+BASIC_EVENT = service(SERVICE, 'urn:Belkin:serviceId:basicevent1',
+                      CONTROL_URL, '/upnp/event/basicevent1',
+                      '/eventservice.xml', eventservice_xml,
+                      {'GetBinaryState': action(returns=('BinaryState',)),
+                       'SetBinaryState': action('_soap_set_binary_state')},
+                      events=('BinaryState',))
 
-class smart_switch(upnp_device):
-    relayState = 0
 
-    def __init__(self, name, listener, poller, ip_address, port,
-                 action_handler=None):
-        self._serial = upnp_device.make_uuid(name)
-        if logger.isEnabledFor(DEBUG):
-            #logger.debug(self.state)
-            pass
+class smart_switch(device_type):
+    UUID_PREFIX = 'Light-1_0-'
+    DESCRIPTION = SETUP_XML
+    SERVICES = (BASIC_EVENT,)
+    STATE = {'BinaryState': 0}
+    __slots__ = ('action_handler',)
 
-        persistent_uuid = "Light-1_0-" + self._serial
-        other_headers = ['X-User-Agent: Solvalou/3.14']
-        upnp_device.__init__(self, listener, poller, port,
-                             "OS2/4.50 UPnP/1.0 UPnP-Device-Host/1.0",
-                             persistent_uuid, other_headers=other_headers,
-                             ip_address=ip_address)
-        self.name = name
+    def __init__(self, name, listener, runtime, ip_address, port,
+                 action_handler=None):
+        device_type.__init__(self, name, listener, runtime, ip_address, port)
 
-        if action_handler:
-            self.action_handler = action_handler
-        else:
-            self.action_handler = self
+        self.action_handler = action_handler or log_handler()
 
         if logger.isEnabledFor(DEBUG):
             logger.debug("Virtual Switch/Light device '%s' ready on %s:%s" %
                          (self._name, self.ip_address, self.port))
 
-    def _resp_msg(self, msg_body):
-        date = email.utils.formatdate(timeval=None, localtime=False,
-                                      usegmt=True)
-        return ("HTTP/1.1 200 OK\r\n"
-                "CONTENT-LENGTH: %d\r\n"
-                "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
-                "DATE: %s\r\n"
-                "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                "%s"
-                "CONNECTION: close\r\n"
-                "\r\n"
-                "%s" % (len(msg_body), date, self.extra_headers, msg_body))
-
-    def _post_upnp(self, data):
-        soap = GetBinaryState_soap % {'state_realy': self.state}
-        return self._resp_msg(soap)
-
-    def _event_srv(self, data):
-        return self._resp_msg(eventservice_xml)
-
-    def _get_setup_xml(self, data):
-        if logger.isEnabledFor(DEBUG):
-            logger.debug("Responding to setup.xml for %s" % self._name)
-        xml = SETUP_XML % {'device_name': self._name,
-                           'device_serial': self._serial}
-        return self._resp_msg(xml)
-
-    def _soap_set_binary_state(self, data):
-        success = True
+    async def _soap_set_binary_state(self, request, soap_action):
+        # The new state is only taken on once the handler has carried the
+        # command out, so GetBinaryState, state.log and the subscribers
+        # never hear of one that failed, or that another replaced before
+        # it ran (that one's answered with the state as it is).
+        data = request.body
         if data.find('<BinaryState>1</BinaryState>') != -1:
             # on
             logger.info("Responding to ON for %s" % self._name)
-            self.relayState = 1
-            success = self.action_handler.on()
+            state, func = 1, self.action_handler.on
         elif data.find('<BinaryState>0</BinaryState>') != -1:
             # off
             logger.info("Responding to OFF for %s" % self._name)
-            self.relayState = 0
-            success = self.action_handler.off()
+            state, func = 0, self.action_handler.off
         else:
-            success = False
             logger.warning("Unknown Binary State request:")
             if logger.isEnabledFor(DEBUG):
                 logger.debug(data)
+            return error_response(500, request.keep_alive)
 
-        if not success:
-            return None
-
-        # The echo is happy with the 200 status code and doesn't
-        # appear to care about the SOAP response body
-        soap = ''
-        return self._resp_msg(soap)
-
-    def notify(self, broadcast_socket):
-        header_nt_usn = []
-        header_nt_usn.append(('upnp:rootdevice',
-                              const.USN_UPNP_ROOT_DEVICE %
-                              self._persistent_uuid))
+        result = await self.command(state, func)
+        if not result:
+            return error_response(500, request.keep_alive)
 
-        header_nt_usn.append((self._persistent_uuid, self._persistent_uuid ))
+        if result is not SUPERSEDED:
+            self.state = state
+        return self.reply(request, soap_action)
 
-        header_nt_usn.append((SERVICE,
-                              'uuid:{0}::{1}'.format(self._persistent_uuid,
-                                                     SERVICE)))
-
-        upnp_device.notify(self, broadcast_socket, header_nt_usn)
-
-    def handle_req(self, data, socket):
-        if logger.isEnabledFor(DEBUG):
-            logger.debug('----- Start ----')
-            logger.debug("data : {0}".format(data))
-        msg = None
+    @property
+    def state(self):
+        return self.get('BinaryState')
 
-        if data.find(const.POST_UPNP) == 0 and \
-                data.find(REQ_GET_BINARY_STATE) != -1:
-            msg  = self._post_upnp(data)
-        elif data.find(const.GET_EVENT_SRV_XML) == 0:
-            msg = self._event_srv(data)
-        elif data.find(const.GET_SETUP_XML) == 0:
-            msg = self._get_setup_xml(data)
-        elif data.find(SOAP_SET_BINARY_STATE) != -1:
-            msg = self._soap_set_binary_state(data)
-        else:
-            if logger.isEnabledFor(DEBUG):
-                logger.debug('Uknown request: {0}'.format(data))
-                logger.debug('---- End ----')
-            return
+    @state.setter
+    def state(self, state):
+        self.set('BinaryState', state)
 
-        socket.send(msg)
-        if logger.isEnabledFor(DEBUG):
-            logger.debug(msg)
-            logger.debug('---- End ----')
 
+# The handler of a device with none configured ('log' in the device file):
+# it only logs. Like any handler it's kept apart from the device, which
+# couldn't be sent to a 'process' ACTION_POOL.
+class log_handler(object):
     def on(self):
         logger.info('turned on')
         return True
@@ -213,14 +138,16 @@ class smart_switch(upnp_device):
         logger.info('turned off')
         return True
 
-    @property
-    def state(self):
-        return self.relayState
+    def dim(self, level):
+        logger.info('dimmed to %d' % level)
+        return True
 
 
 # This is an example handler class. The fauxmo class expects handlers to be
 # instances of objects that have on() and off() methods that return True
-# on success and False otherwise.
+# on success and False otherwise. They are run off the event loop by the
+# runtime's action_executor, so they may block; on() and off() may also be
+# coroutine functions, in which case they are awaited on the loop.
 #
 # This example class takes two full URLs that should be requested when an on
 # and off command are invoked respectively. It ignores any return data.
@@ -236,37 +163,3 @@ class action_to_black_bean(object):
     def off(self):
         logger.info(self._off)
         return True
-
-
-DEFINITION = [
-    # ['office lights', 'cmd=on&a=office', 'cmd=off&a=office'],
-    # ['kitchen lights', 'cmd=on&a=kitchen', 'cmd=off&a=kitchen'],
-    # ['bedroom lights', 'cmd=on&a=bedroom', 'cmd=off&a=bedroom'],
-    # ['dining room lights', 'cmd=on&a=dining', 'cmd=off&a=dining'],
-    # ['home room lights', 'cmd=on&a=homeroom', 'cmd=off&a=homeroom'],
-    # ['my room lights', 'cmd=on&a=myroom', 'cmd=off&a=myroom'],
-    ['something', 'file name for turn on', 'file name for turn off'],
-]
-
-
-SWITCHES = []
-
-switches = []
-
-def load(listener, poller):
-    for name, on, off in DEFINITION:
-        device = [name, action_to_black_bean(on, off)]
-        SWITCHES.append(device)
-
-    for one in SWITCHES:
-        if len(one) == 2:
-            # a fixed port wasn't specified, use a dynamic one
-            one.append(0)
-        switch = smart_switch(one[0], listener, poller, None,
-                              one[2], action_handler=one[1])
-
-        switches.append(switch)
-
-def notify(broadcast_socket):
-    for switch in switches:
-        switch.notify(broadcast_socket)
@@ -0,0 +1,206 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+from logging import getLogger, DEBUG
+import os
+import socket
+import struct
+import sys
+import time
+
+import const
+
+logger = getLogger('devel')
+
+SSDP_ADDR = ('239.255.255.250', 1900)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    # The socket module has no sendmmsg(), so go to libc for it on Linux.
+    # Anywhere else (or if anything about it looks off) we fall back to a
+    # sendto() per datagram.
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                         ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _sockaddr_in(dest):
+    return (struct.pack('=H', socket.AF_INET) + struct.pack('!H', dest[1]) +
+            socket.inet_aton(dest[0]) + b'\0' * 8)
+
+
+class ssdp_sender(object):
+    # One UDP socket for every outgoing SSDP datagram, search replies and
+    # NOTIFYs alike. Callers hand over whole batches of (payload, dest)
+    # pairs, which go out with as few syscalls as the platform allows,
+    # paced by a token bucket (SSDP_SEND_RATE datagrams a second with
+    # bursts of SSDP_SEND_BURST) so a few hundred devices don't flood
+    # the multicast group.
+    def __init__(self, loop, rate=const.SSDP_SEND_RATE,
+                 burst=const.SSDP_SEND_BURST):
+        self._loop = loop
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._queue = collections.deque()
+        self._timer = None
+        self._writing = False
+        self._drained = []
+        self.sent = 0
+        self.syscalls = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                     socket.IPPROTO_UDP)
+        self._socket.setblocking(False)
+
+    @property
+    def socket(self):
+        return self._socket
+
+    def send(self, packets):
+        self._queue.extend(packets)
+        if not self._timer and not self._writing:
+            self._flush()
+
+    def _flush(self):
+        self._timer = None
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+        count = min(int(self._tokens), len(self._queue))
+        if count:
+            batch = [self._queue.popleft() for _ in range(count)]
+            sent = self._send_batch(batch)
+            self._tokens -= sent
+            self.sent += sent
+            if sent < count:
+                # socket buffer full, resume once it drains
+                self._queue.extendleft(reversed(batch[sent:]))
+                self._writing = True
+                self._loop.add_writer(self._socket.fileno(), self._writable)
+                return
+
+        if not self._queue:
+            for waiter in self._drained:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._drained = []
+            return
+
+        # wait for enough tokens to make the next batch worth a syscall
+        wanted = min(len(self._queue), max(1, int(self._burst) // 5))
+        delay = (wanted - self._tokens) / self._rate
+        self._timer = self._loop.call_later(max(delay, 0), self._flush)
+
+    async def drain(self):
+        # Wait until everything queued so far has been handed to the kernel
+        if self._queue:
+            waiter = self._loop.create_future()
+            self._drained.append(waiter)
+            await waiter
+
+    def _writable(self):
+        self._loop.remove_writer(self._socket.fileno())
+        self._writing = False
+        self._flush()
+
+    def _send_batch(self, batch):
+        if _sendmmsg and len(batch) > 1:
+            return self._sendmmsg(batch)
+
+        sent = 0
+        for payload, dest in batch:
+            try:
+                self._socket.sendto(payload, dest)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.warning("Failed to send to %s: %s" % (dest, e))
+            self.syscalls += 1
+            sent += 1
+
+        return sent
+
+    def _sendmmsg(self, batch):
+        count = len(batch)
+        msgs = (_mmsghdr * count)()
+        iovs = (_iovec * count)()
+        keep = []
+        for i, (payload, dest) in enumerate(batch):
+            data = ctypes.create_string_buffer(payload, len(payload))
+            name = ctypes.create_string_buffer(_sockaddr_in(dest), 16)
+            keep.append((data, name))
+            iovs[i].iov_base = ctypes.addressof(data)
+            iovs[i].iov_len = len(payload)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(name)
+            hdr.msg_namelen = 16
+            hdr.msg_iov = ctypes.pointer(iovs[i])
+            hdr.msg_iovlen = 1
+
+        sent = 0
+        while sent < count:
+            first = ctypes.cast(ctypes.addressof(msgs) +
+                                sent * ctypes.sizeof(_mmsghdr),
+                                ctypes.POINTER(_mmsghdr))
+            done = _sendmmsg(self._socket.fileno(), first, count - sent, 0)
+            self.syscalls += 1
+            if done < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.ENOBUFS):
+                    break
+                # skip the datagram the kernel choked on
+                logger.warning("sendmmsg failed: %s" % os.strerror(error))
+                sent += 1
+                continue
+            sent += done
+
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("sent %d datagrams" % sent)
+        return sent
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._writing:
+            self._loop.remove_writer(self._socket.fileno())
+            self._writing = False
+        self._socket.close()
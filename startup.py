@@ -0,0 +1,29 @@
+from logging import getLogger
+import time
+
+logger = getLogger('devel')
+
+
+class phases(object):
+    # Times the steps of starting up: each done() ends the phase that began
+    # at the one before (or at `start`), and report() logs them on one line.
+    # The runtime keeps them for the metrics.
+    def __init__(self, start=None):
+        self._start = start or time.perf_counter()
+        self._last = self._start
+        # (phase, seconds) in the order they ran
+        self.timings = []
+
+    def done(self, phase):
+        now = time.perf_counter()
+        self.timings.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+    def report(self):
+        logger.info("Started in %.1f ms (%s)" % (
+            self.total * 1000, ', '.join('%s %.1f ms' % (phase, seconds * 1000)
+                                        for phase, seconds in self.timings)))
@@ -0,0 +1,151 @@
+import concurrent.futures
+import json
+from logging import getLogger
+import os
+import time
+
+import const
+
+logger = getLogger('devel')
+
+
+class state_store(object):
+    # Remembers each device's relay state, and when it last changed, across
+    # restarts. The file is an append-only log of JSON lines, the last line
+    # for a device winning. set() only touches memory; changes are written
+    # behind, STATE_FLUSH_DELAY seconds after the first of a run of them,
+    # as one append (and fsync) of the latest state of every device that
+    # changed, on a thread of its own so the loop never waits for the
+    # disk. The log is rewritten from memory every STATE_COMPACT_INTERVAL
+    # seconds once it has grown to more than twice the live records.
+    def __init__(self, loop, path=const.STATE_FILE,
+                 delay=const.STATE_FLUSH_DELAY,
+                 compact_interval=const.STATE_COMPACT_INTERVAL):
+        self._loop = loop
+        self._path = path
+        self._delay = delay
+        self._compact_interval = compact_interval
+        self._states = {}
+        self._dirty = set()
+        self._records = 0
+        self._timer = None
+        self._compact_timer = None
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='state')
+        self.writes = 0
+
+        if self._path:
+            self.load()
+            self._compact_timer = self._loop.call_later(
+                self._compact_interval, self._compact)
+
+    def load(self):
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._states[record['n']] = (record['s'], record['t'])
+                    except (ValueError, KeyError):
+                        # most likely a line cut short by a crash
+                        logger.warning("Skipping bad line in %s" % self._path)
+                        continue
+                    self._records += 1
+        except FileNotFoundError:
+            return
+
+        logger.info("Restored state of %d devices from %s" %
+                    (len(self._states), self._path))
+
+    def get(self, name, default=0):
+        entry = self._states.get(name)
+        if entry is None:
+            return default
+
+        return entry[0]
+
+    def changed(self, name):
+        entry = self._states.get(name)
+        if entry is None:
+            return None
+
+        return entry[1]
+
+    def set(self, name, state):
+        self._states[name] = (state, time.time())
+        if not self._path:
+            return
+
+        self._dirty.add(name)
+        if not self._timer:
+            self._timer = self._loop.call_later(self._delay, self._flush)
+
+    def _pending(self):
+        lines = [json.dumps({'n': name, 's': self._states[name][0],
+                             't': self._states[name][1]}) + '\n'
+                 for name in self._dirty if name in self._states]
+        self._dirty.clear()
+        self._records += len(lines)
+        return lines
+
+    def _flush(self):
+        self._timer = None
+        lines = self._pending()
+        if lines:
+            self._writer.submit(self._append, lines).add_done_callback(
+                self._written)
+
+    def _append(self, lines):
+        with open(self._path, 'a') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _written(self, future):
+        self.writes += 1
+        if future.exception():
+            logger.error("Failed to write %s: %s" %
+                         (self._path, future.exception()))
+
+    def _snapshot(self):
+        return [json.dumps({'n': name, 's': state, 't': changed}) + '\n'
+                for name, (state, changed) in self._states.items()]
+
+    def _compact(self):
+        self._compact_timer = self._loop.call_later(self._compact_interval,
+                                                    self._compact)
+        if self._records <= 2 * len(self._states):
+            return
+
+        # Whatever is still dirty is in the snapshot, so it needn't be
+        # appended again.
+        self._dirty.clear()
+        lines = self._snapshot()
+        self._records = len(lines)
+        self._writer.submit(self._rewrite, lines).add_done_callback(
+            self._written)
+
+    def _rewrite(self, lines):
+        temp = self._path + '.tmp'
+        with open(temp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self._path)
+
+    def forget(self, name):
+        self._states.pop(name, None)
+        self._dirty.discard(name)
+
+    def close(self):
+        # Write out whatever is still pending and wait for it
+        for timer in (self._timer, self._compact_timer):
+            if timer:
+                timer.cancel()
+        self._timer = self._compact_timer = None
+
+        if self._path:
+            lines = self._pending()
+            if lines:
+                self._writer.submit(self._append, lines)
+        self._writer.shutdown(wait=True)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Plays a trace recorded by smart_home (see TRACE_RECORDS in const.py) back
+# through the code that handled it, offline: SSDP datagrams go to the
+# listener's datagram_received() and HTTP reads, put back together into
+# requests, to the handle_req() of the device they were for. The devices
+# are those of the device file, with no-op handlers, and nothing is sent
+# anywhere. Records are fed as fast as they can be taken, or with the
+# timing they were recorded with (--timing, sped up by --speed), and the
+# time taken to handle each kind of request is reported, e.g.
+#
+#   ./trace_replay.py smart_home.trace --repeat 10
+#
+# Devices take their serials, UUIDs and ports from the allocations file, so
+# replay a trace with the files it was recorded with. GENA SUBSCRIBE and
+# UNSUBSCRIBE requests are skipped: their callbacks are real hosts. The
+# per-client rate limits apply as they did live, which played back faster
+# than it was recorded (or repeated) turns reads away; --no-limits lifts
+# them.
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import math
+import sys
+import time
+
+import const
+import devices
+from clients import client_table
+from echo_bench import null_handler, percentile
+from http_server import request_parser
+import interfaces
+import packet_trace
+from upnp_handler import runtime, upnp_broadcaster
+
+# Records fed between yields to the loop at line rate
+BATCH = 64
+
+
+class null_sender(object):
+    # Stands in for the ssdp_sender: counts what would have gone out
+    def __init__(self):
+        self.sent = 0
+        self.syscalls = 0
+
+    @property
+    def socket(self):
+        return None
+
+    def send(self, packets):
+        self.sent += len(packets)
+        self.syscalls += 1
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class null_writer(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def request_type(request):
+    # 'SetBinaryState', 'setup.xml', ...
+    return (request.soap_action.rpartition('#')[2] or
+            request.path.rpartition('/')[2] or request.method)
+
+
+class replayer(object):
+    # Feeds records to a runtime's listener and devices. `routes` maps
+    # the port a device listened on to the device; reads on any other port
+    # went to the shared HTTP listener. A connection's requests are
+    # handled one after another, as they were.
+    def __init__(self, rt, listener, routes):
+        self._rt = rt
+        self._listener = listener
+        self._routes = routes
+        self._parsers = {}
+        # connection number -> task handling its last request
+        self._tails = {}
+        # request type -> seconds taken
+        self.latency = collections.defaultdict(list)
+        self.datagrams = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def feed(self, record):
+        stamp, kind, peer, port, number, data = record
+        if kind == packet_trace.SSDP:
+            self.datagrams += 1
+            self._listener.received += 1
+            self._listener.datagram_received(bytearray(data), len(data),
+                                             peer)
+            return
+
+        parser = self._parsers.get(number)
+        if parser is None:
+            parser = self._parsers[number] = request_parser()
+        try:
+            requests = parser.feed(data)
+        except ValueError:
+            # e.g. the ring had dropped the start of the connection
+            self.errors += 1
+            del self._parsers[number]
+            return
+
+        target = self._routes.get(port, self._rt.http_server)
+        for request in requests:
+            if request.method in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+                self.skipped += 1
+                continue
+            request.client = peer[0]
+
+            self._tails[number] = self._rt.loop.create_task(self._handle(
+                target, request, self._tails.get(number)))
+
+    async def _handle(self, target, request, previous):
+        if previous:
+            await previous
+        kind = request_type(request)
+        start = time.perf_counter()
+        try:
+            await target.handle_req(request, null_writer())
+        except Exception as e:
+            logging.warning("%s failed: %s" % (kind, e))
+            self.errors += 1
+            return
+
+        self.latency[kind].append(time.perf_counter() - start)
+
+    async def finish(self):
+        await asyncio.gather(*self._tails.values())
+        self._tails.clear()
+        self._parsers.clear()
+
+
+def setup(args):
+    # A runtime with the devices of the device file, serving nothing
+    rt = runtime(state_file=None, allocations_file=None, trace_file=None,
+                 sender=null_sender())
+    try:
+        with open(args.allocations) as f:
+            rt.allocations.update(json.load(f))
+    except FileNotFoundError:
+        logging.warning("No %s, devices get new serials and UUIDs" %
+                        args.allocations)
+    if args.no_limits:
+        # bursts nobody gets to the end of
+        rt.clients = client_table(rt.loop, search_burst=math.inf,
+                                  request_burst=math.inf,
+                                  command_burst=math.inf)
+
+    listener = upnp_broadcaster()
+    listener.interfaces = interfaces.table()
+    rt.add_listener(listener)
+    rt.share_http('127.0.0.1', 0)
+
+    for name in list(devices.HANDLERS):
+        devices.register_handler(name, lambda *args, **kwargs:
+                                 null_handler())
+    registry = devices.device_registry(listener, rt, path=args.devices)
+    specs = registry.read()
+    registry.apply(specs)
+
+    # where each device listened: its configured port or the one it was
+    # allocated
+    allocated = rt.allocations.entries(registry.switches)
+    routes = {}
+    for name, switch in registry.switches.items():
+        routes[specs[name]['port'] or allocated[name]['port']] = switch
+
+    return rt, listener, routes
+
+
+async def replay(args, rt, listener, routes, records):
+    player = replayer(rt, listener, routes)
+    sent = rt.ssdp.sent
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        began = time.perf_counter()
+        first = records[0][0]
+        for count, record in enumerate(records, 1):
+            if args.timing:
+                delay = ((record[0] - first) / args.speed -
+                         (time.perf_counter() - began))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            player.feed(record)
+            if not args.timing and count % BATCH == 0:
+                await asyncio.sleep(0)
+        await player.finish()
+    elapsed = time.perf_counter() - start
+
+    # search replies are spread over the searchers' MX
+    await asyncio.sleep(args.settle)
+    return player, elapsed, rt.ssdp.sent - sent
+
+
+def report(args, rt, player, elapsed, replies):
+    throttled = collections.Counter()
+    for c in rt.clients:
+        throttled.update(c.throttled)
+    result = {'datagrams': player.datagrams, 'ssdp_replies': replies,
+              'skipped': player.skipped, 'errors': player.errors,
+              'elapsed': elapsed,
+              'throttled_searches': throttled['search'],
+              'throttled_requests': throttled['request'],
+              'throttled_commands': throttled['command']}
+    requests = 0
+    for kind, latency in sorted(player.latency.items()):
+        requests += len(latency)
+        result[kind + '_p50'] = percentile(latency, 50)
+        result[kind + '_p99'] = percentile(latency, 99)
+        result[kind + '_count'] = len(latency)
+    result['requests_per_sec'] = requests / elapsed if elapsed else 0
+
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+
+    print("%d datagrams, %d SSDP replies, %d requests (%d skipped)" %
+          (player.datagrams, replies, requests, player.skipped))
+    if throttled:
+        print("throttled %d searches, %d requests, %d commands" %
+              (throttled['search'], throttled['request'],
+               throttled['command']))
+    print("%-16s %10s %10s %8s" % ('', 'p50 ms', 'p99 ms', 'count'))
+    for kind in sorted(player.latency):
+        print("%-16s %10.2f %10.2f %8d" % (kind,
+                                           result[kind + '_p50'] * 1000,
+                                           result[kind + '_p99'] * 1000,
+                                           result[kind + '_count']))
+    print("%.0f requests/sec, %d errors, %.2fs total" %
+          (result['requests_per_sec'], player.errors, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a smart_home trace against its devices')
+    parser.add_argument('trace')
+    parser.add_argument('--devices', default=const.DEVICES_FILE)
+    parser.add_argument('--allocations', default=const.ALLOCATIONS_FILE)
+    parser.add_argument('--timing', action='store_true',
+                        help='keep the time between records')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='with --timing, play this many times faster')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-limits', action='store_true',
+                        help="don't rate limit the clients")
+    parser.add_argument('--settle', type=float, default=const.SSDP_MAX_MX,
+                        help='seconds to wait for search replies at the end')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    records = list(packet_trace.read(args.trace))
+    if not records:
+        print("%s has no records" % args.trace, file=sys.stderr)
+        return 1
+
+    rt, listener, routes = setup(args)
+    try:
+        player, elapsed, replies = rt.loop.run_until_complete(
+            replay(args, rt, listener, routes, records))
+        report(args, rt, player, elapsed, replies)
+    finally:
+        rt.connections.close()
+        rt.executor.shutdown()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
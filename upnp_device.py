@@ -1,88 +1,128 @@
 import email.utils
 from logging import getLogger, DEBUG
 import socket
+import time
 import uuid
 
 import const
+import http_server
+import interfaces
+from metrics import REGISTRY
+from ssdp_sender import SSDP_ADDR
 
 logger = getLogger('devel')
 
+KEEP_ALIVE = b"CONNECTION: keep-alive\r\n\r\n"
+CLOSE = b"CONNECTION: close\r\n\r\n"
+
+_date = [0, b'']
+
+# value -> the one copy of it, for header blocks and response heads that are
+# the same for many devices
+_interned = {}
+
+
+def interned(value):
+    return _interned.setdefault(value, value)
+
+
+def http_date():
+    # formatdate() is comparatively slow and only changes once a second,
+    # so every response rendered within the same second shares one copy.
+    now = int(time.time())
+    if now != _date[0]:
+        _date[0] = now
+        _date[1] = email.utils.formatdate(
+            timeval=now, localtime=False, usegmt=True).encode('ascii')
+
+    return _date[1]
+
 
 class upnp_device(object):
-    host_ip = None
+    # There may be thousands of these, so they keep no __dict__: subclasses
+    # list their own attributes in __slots__ too (one that doesn't just
+    # gets a __dict__ back). What's the same for every device of a kind is
+    # kept on the class or interned().
+    __slots__ = ('_listener', '_runtime', 'port', 'ip_address', 'url_prefix',
+                 '_server_version', '_persistent_uuid', '_uuid',
+                 '_other_headers', '_extra_headers', '_responses', '_name',
+                 '_any_address', '_socket', 'metrics')
 
     @staticmethod
     def local_ip():
-        if not upnp_device.host_ip:
-            temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            try:
-                temp_socket.connect(('8.8.8.8', 53))
-                upnp_device.host_ip = temp_socket.getsockname()[0]
-            except socket.error:
-                upnp_device.host_ip = '127.0.0.1'
-
-            del(temp_socket)
-            logger.info("got local address of %s" % upnp_device.host_ip)
-
-        return upnp_device.host_ip
+        # the primary interface's address, found without going on the network
+        return interfaces.table().primary
 
     @staticmethod
     def make_uuid(name):
         return ''.join(["%x" % sum([ord(c) for c in name])] +
                        ["%x" % ord(c) for c in "%sXevious!" % name])[:14]
 
-    def __init__(self, listener, poller, port, server_version,
-                 persistent_uuid, other_headers=None, ip_address=None):
+    def __init__(self, listener, runtime, port, server_version,
+                 persistent_uuid, other_headers=None, ip_address=None,
+                 device_uuid=None):
         self._listener = listener
-        self._poller = poller
+        self._runtime = runtime
         self.port = port
         self._server_version = server_version
         self._persistent_uuid = persistent_uuid
-        self._uuid = uuid.uuid4()
+        self._uuid = device_uuid or uuid.uuid4()
         self._other_headers = other_headers
-
+        self._extra_headers = None
+        self._responses = {}
+        self._name = None
+
+        # Without an address the device listens on every interface and
+        # each searcher is given a LOCATION on its own; ip_address is then
+        # just the primary address, used in NOTIFYs.
+        self._any_address = not ip_address
         if ip_address:
             self.ip_address = ip_address
         else:
             self.ip_address = upnp_device.local_ip()
 
-        ''' TCP server socket
-        '''
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.bind((self.ip_address, self.port))
-        self._socket.listen(5)
-        if self.port == 0:
-            self.port = self._socket.getsockname()[1]
-
-        self._poller.add(self)
-        self._client_sockets = {}
+        shared = self._runtime.http_server
+        if shared:
+            ''' served by the runtime's shared listener
+            '''
+            self._socket = None
+            self.ip_address = shared.ip_address
+            self._any_address = shared.any_address
+            self.port = shared.port
+            self.url_prefix = '/' + self._persistent_uuid
+            shared.add(self)
+        else:
+            ''' TCP server socket
+            '''
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._socket.bind(('' if self._any_address else self.ip_address,
+                               self.port))
+            self._socket.listen(const.CONNECTION_BACKLOG)
+            if self.port == 0:
+                self.port = self._socket.getsockname()[1]
+            self.url_prefix = ''
+            self._runtime.add(self)
+
+        self.metrics = REGISTRY.add(self, persistent_uuid)
         self._listener.add_device(self)
+        self._runtime.advertiser.add(self)
 
-    def fileno(self):
-        return self._socket.fileno()
-
-    def read(self, fileno):
-        if fileno == self._socket.fileno():
-            ''' server socket
-            '''
-            (client_socket, client_address) = self._socket.accept()
-            self._poller.add(self, client_socket.fileno())
-            self._client_sockets[client_socket.fileno()] = client_socket
-            return
+    def stop(self):
+        # Take the device off the network: byebye, stop listening and
+        # forget about it.
+        self._listener.remove_device(self)
+        self._runtime.remove(self)
 
-        data, _ = self._client_sockets[fileno].recvfrom(4096)
-        if not data:
-            self._poller.remove(self, fileno)
-            del(self._client_sockets[fileno])
-            return
+    @property
+    def socket(self):
+        return self._socket
 
-        if logger.isEnabledFor(DEBUG):
-            logger.debug('----- Start ----')
-        self.handle_req(data, self._client_sockets[fileno])
-        if logger.isEnabledFor(DEBUG):
-            logger.debug('---- End ----')
+    async def handle_client(self, reader, writer, conn=None):
+        await http_server.serve(reader, writer, self.handle_req,
+                                self.metrics, conn)
 
-    def handle_req(self, data, socket):
+    async def handle_req(self, request, writer):
         pass
 
     @property
@@ -94,77 +134,141 @@ class upnp_device(object):
 
     @name.setter
     def name(self, name):
+        self._runtime.devices.rename(self, self._name, name)
         self._name = name
+        self.metrics.name = name
+        self.invalidate()
 
     @property
     def extra_headers(self):
-        headers = ''
-        for header in self._other_headers:
-            headers += "%s\r\n" % header
-        
-        return headers
-
-    def notify(self, broadcast_socket, headers):
-        date_str = email.utils.formatdate(
-            timeval=None, localtime=False, usegmt=True)
-
+        if self._extra_headers is None:
+            self._extra_headers = interned(''.join(
+                "%s\r\n" % header for header in self._other_headers or []))
+
+        return self._extra_headers
+
+    def cached_response(self, key, render, keep_alive=False, cache=None):
+        # Responses are rendered and encoded once per device and kept
+        # split around the DATE and CONNECTION values, so serving one is
+        # a matter of gluing a few buffers together. render() is only
+        # called on a miss; use invalidate() when whatever it depends on
+        # changes. Responses that are the same for many devices can be
+        # kept in a cache of their own instead.
+        if cache is None:
+            cache = self._responses
+        response = cache.get(key)
+        if response is None:
+            response = self._render_response(render())
+            cache[key] = response
+
+        return b''.join((response[0], http_date(), response[1],
+                         KEEP_ALIVE if keep_alive else CLOSE, response[2]))
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._responses.clear()
+        else:
+            self._responses.pop(key, None)
+
+    def _render_response(self, msg_body):
+        msg_body = msg_body.encode('utf-8')
+        head = ("HTTP/1.1 200 OK\r\n"
+                "CONTENT-LENGTH: %d\r\n"
+                "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
+                "DATE: " % len(msg_body))
+        tail = ("\r\n"
+                "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                "%s" % self.extra_headers)
+        return (interned(head.encode('utf-8')),
+                interned(tail.encode('utf-8')), msg_body)
+
+    def nt_usn(self):
+        # (NT, USN) pairs this device announces itself with
+        return [('upnp:rootdevice',
+                 const.USN_UPNP_ROOT_DEVICE % self._persistent_uuid),
+                (self._persistent_uuid, self._persistent_uuid)]
+
+    def notify_packets(self, nts='ssdp:alive'):
+        # Built when needed rather than kept: a device only sends them once
+        # an advertising interval, and kept they'd take more memory than the
+        # rest of it.
         location_url = const.URL_DES_XML % {
-            'ip_address': self.ip_address, 'port': self.port}
-
-        for nt, usn in headers:
-            msg = ("NOTIFY * HTTP/1.1\r\n"
-                   "HOST: 239.255.255.250:1900\r\n"
-                   "CACHE-CONTROL: max-age=86400\r\n"
-                   "LOCATION: %(loc)s\r\n"
-                   "NT: %(nt)s\r\n"
-                   "NTS: ssdp:alive\r\n"
-                   "SERVER: %(server)s\r\n"
-                   "USN: %(usn)s\r\n"
-                   "\r\n"
-                   % { 'loc':location_url, 'nt':nt,
-                       'server':self._server_version,
-                       'usn':usn })
+            'ip_address': self.ip_address, 'port': self.port,
+            'prefix': self.url_prefix}
+
+        packets = []
+        for nt, usn in self.nt_usn():
+            if nts == 'ssdp:byebye':
+                msg = ("NOTIFY * HTTP/1.1\r\n"
+                       "HOST: 239.255.255.250:1900\r\n"
+                       "NT: %(nt)s\r\n"
+                       "NTS: %(nts)s\r\n"
+                       "USN: %(usn)s\r\n"
+                       "\r\n"
+                       % { 'nt':nt, 'nts':nts, 'usn':usn })
+            else:
+                msg = ("NOTIFY * HTTP/1.1\r\n"
+                       "HOST: 239.255.255.250:1900\r\n"
+                       "CACHE-CONTROL: max-age=%(max_age)d\r\n"
+                       "LOCATION: %(loc)s\r\n"
+                       "NT: %(nt)s\r\n"
+                       "NTS: %(nts)s\r\n"
+                       "SERVER: %(server)s\r\n"
+                       "USN: %(usn)s\r\n"
+                       "\r\n"
+                       % { 'max_age':const.SSDP_MAX_AGE,
+                           'loc':location_url, 'nt':nt, 'nts':nts,
+                           'server':self._server_version,
+                           'usn':usn })
 
             if logger.isEnabledFor(DEBUG):
                 logger.debug(msg)
-           
-            broadcast_socket.sendto(msg, ('239.255.255.250', 1900))
-            broadcast_socket.sendto(msg, ('239.255.255.250', 1900))
-
-        if logger.isEnabledFor(DEBUG):
-            logger.debug('---- End ----')
 
-        pass
+            packets.append(msg.encode('utf-8'))
+
+        return packets
+
+    def notify(self, sender, nts='ssdp:alive'):
+        # every NOTIFY goes out twice, UDP being what it is
+        packets = [(msg, SSDP_ADDR) for msg in self.notify_packets(nts)]
+        sender.send(packets * 2)
+
+    def search_response(self, search_target, address=None):
+        # address is ours on the searcher's interface
+        if not self._any_address or not address:
+            address = self.ip_address
+        key = ('M-SEARCH', search_target, address)
+        response = self._responses.get(key)
+        if response is None:
+            location_url = const.URL_SETUP_XML % {
+                'ip_address': address, 'port': self.port,
+                'prefix': self.url_prefix}
+
+            head = ("HTTP/1.1 200 OK\r\n"
+                    "CACHE-CONTROL: max-age=%d\r\n"
+                    "DATE: " % const.SSDP_MAX_AGE)
+            tail = ("\r\n"
+                    "LOCATION: %s\r\n"
+                    "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
+                    "01-NLS: %s\r\n"
+                    "SERVER: %s\r\n"
+                    "ST: %s\r\n"
+                    "USN: uuid:%s::%s\r\n"
+                    "%s"
+                    "\r\n" % (
+                     location_url, self._uuid, self._server_version,
+                     search_target, self._persistent_uuid, search_target,
+                     self.extra_headers))
+            response = (interned(head.encode('utf-8')),
+                        tail.encode('utf-8'))
+            self._responses[key] = response
+
+        return b''.join((response[0], http_date(), response[1]))
 
     def respond_to_search(self, dest, search_target):
         if logger.isEnabledFor(DEBUG):
-            logger.debug('----- Start ----')
             logger.debug("Responding to search for %s" % self.name)
 
-        date_str = email.utils.formatdate(
-            timeval=None, localtime=False, usegmt=True)
-
-        location_url = const.URL_SETUP_XML % {
-            'ip_address': self.ip_address, 'port': self.port}
-
-        message = ("HTTP/1.1 200 OK\r\n"
-                   "CACHE-CONTROL: max-age=86400\r\n"
-                   "DATE: %s\r\n"
-                   "LOCATION: %s\r\n"
-                   "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
-                   "01-NLS: %s\r\n"
-                   "SERVER: %s\r\n"
-                   "ST: %s\r\n"
-                   "USN: uuid:%s::%s\r\n" % (
-                    date_str, location_url, self._uuid, self._server_version,
-                    search_target, self._persistent_uuid, search_target))
-
-        message += self.extra_headers
-        message += "\r\n"
-
-        if logger.isEnabledFor(DEBUG):
-            logger.debug(message)
-        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_socket.sendto(message, dest)
-        if logger.isEnabledFor(DEBUG):
-            logger.debug('---- End ----')
+        address = interfaces.table().address_for(dest[0])
+        self._runtime.ssdp.send([(self.search_response(search_target, address),
+                                  dest)])
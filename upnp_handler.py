@@ -26,81 +26,320 @@ THE SOFTWARE.
 
 # For a complete discussion, see http://www.makermusings.com
 
+import asyncio
+import collections
+import ipaddress
 from logging import getLogger, DEBUG
-import select
+import random
+import re
+import signal
 import socket
-import struct
-import time
 
+from action_executor import action_executor
+from allocations import allocation_table
+from clients import client_table
+from advertiser import advertiser
+from connections import connection_manager
 from const import ALEXA
+from const import ALLOCATIONS_FILE
+from const import CONNECTION_MAX
 from const import FILTER
+from const import SSDP_ALLOW
+from const import SSDP_MAX_MX
+from const import SSDP_SEARCH_WINDOW
+from const import STATE_FILE
+from const import TRACE_FILE
+from const import TRACE_RECORDS
+from gena import event_publisher
+from http_server import shared_http_server
+import interfaces
+import metrics
+from packet_trace import trace_recorder
+from ssdp_sender import ssdp_sender
+from state_store import state_store
 
 logger = getLogger('devel')
 
 
-class poller:
-    # A simple utility class to wait for incoming data to be
-    # ready on a socket.
+class device_index(object):
+    # The runtime's one table of its devices, by name. Devices join it
+    # when they're given their name and are dropped by runtime.remove().
+    __slots__ = ('by_name',)
+
     def __init__(self):
-        self._poller = None
+        self.by_name = {}
+
+    def rename(self, device, old, new):
+        if self.by_name.get(old) is device:
+            del self.by_name[old]
+        self.by_name[new] = device
+
+    def remove(self, device):
+        if self.by_name.get(device.name) is device:
+            del self.by_name[device.name]
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+class runtime(object):
+    # Drives every socket from a single asyncio event loop. The kernel
+    # wakes the loop as soon as a datagram or connection arrives, so the
+    # time to handle a request is bounded by the network, not by a tick.
+    def __init__(self, loop=None, state_file=STATE_FILE,
+                 allocations_file=ALLOCATIONS_FILE, trace_file=TRACE_FILE,
+                 sender=None):
+        if not loop:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+        self.loop = loop
+        self.executor = action_executor(loop)
+        # anything with ssdp_sender's interface, e.g. to replay a trace
+        # without sending anything
+        self.ssdp = sender or ssdp_sender(loop)
+        self.advertiser = advertiser(loop, self.ssdp)
+        self.state = state_store(loop, state_file)
+        self.allocations = allocation_table(loop, allocations_file)
+        self.events = event_publisher(loop)
+        self.http_server = None
+        self.devices = device_index()
+        self.listeners = []
+        # the process's startup.phases, if it timed them
+        self.startup = None
+        self.trace = None
+        if TRACE_RECORDS and trace_file:
+            self.trace = trace_recorder(trace_file, TRACE_RECORDS)
+        self.connections = connection_manager(loop, trace=self.trace)
+        self.clients = client_table(loop)
+
+    def serve_metrics(self, ip_address, port):
+        self.add(metrics.metrics_server(self, ip_address, port))
+
+    def share_http(self, ip_address='', port=0):
+        # Devices created after this call are served from one listening
+        # socket instead of binding one each.
+        self.http_server = shared_http_server(
+            ip_address, port, metrics.REGISTRY.add(self, 'shared'))
+        self.add(self.http_server, CONNECTION_MAX)
+        return self.http_server
+
+    def add(self, device, limit=None):
+        # Accept connections on the device's already bound TCP socket;
+        # anything with a socket and a handle_client() coroutine will do.
+        self.connections.listen(device, limit)
+
+    def remove(self, device):
+        self.devices.remove(device)
+        self.advertiser.remove(device)
+        self.executor.forget(device)
+        self.events.forget(device)
+        metrics.REGISTRY.remove(device)
+        if device.socket:
+            self.connections.unlisten(device)
+        elif self.http_server:
+            self.http_server.remove(device)
+
+    def add_listener(self, listener):
+        # Wake the SSDP listener whenever its multicast socket is readable
+        self.listeners.append(listener)
+        listener.start(self.loop, self.ssdp, self.trace, self.clients)
+
+    def _serving(self):
+        # everything is listening from the loop's first pass
+        self.startup.done('loop start')
+        self.startup.report()
+
+    def save_trace(self):
+        try:
+            self.trace.save()
+        except OSError as e:
+            logger.error("Failed to write the trace: %s" % e)
+
+    def run(self):
+        # SIGTERM (and ctrl-c) stop the loop so the devices get to say
+        # goodbye before we go.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.loop.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.startup:
+            self.loop.call_soon(self._serving)
+        if self.trace:
+            try:
+                self.loop.add_signal_handler(signal.SIGUSR1, self.save_trace)
+            except (NotImplementedError, RuntimeError, AttributeError):
+                pass
+
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("Shutting down")
+            self.loop.run_until_complete(self.advertiser.shutdown())
+            if self.trace:
+                self.save_trace()
+            self.connections.close()
+            for listener in self.listeners:
+                listener.close()
+            self.events.close()
+            self.executor.shutdown()
+            self.state.close()
+            self.allocations.close()
+            self.ssdp.close()
+            self.loop.close()
+
+
+class search_scheduler(object):
+    # Answers M-SEARCH requests without ever blocking the loop. Each
+    # device's reply is put on a timer at a random point inside the
+    # requester's MX window, as the UPnP spec asks, and repeated searches
+    # from the same sender within SSDP_SEARCH_WINDOW seconds are folded
+    # into the replies already scheduled. Replies name the address of the
+    # interface the searcher is on.
+    MX_RE = re.compile(br'\r\nMX:[ \t]*(\d+)', re.IGNORECASE)
+
+    # Devices are split into at most this many groups, each answered
+    # with one batch at its own random point in the window.
+    SLOTS = 8
+
+    def __init__(self, loop, sender, window=SSDP_SEARCH_WINDOW,
+                 max_mx=SSDP_MAX_MX, addresses=None):
+        self._loop = loop
+        self._sender = sender
+        self._addresses = addresses or interfaces.table()
+        self._window = window
+        self._max_mx = max_mx
+        self._recent = set()
+        self.answered = 0
+        self.coalesced = 0
+
+    def mx(self, data, size):
+        match = self.MX_RE.search(data, 0, size)
+        if not match:
+            return 1
+
+        return max(1, min(int(match.group(1)), self._max_mx))
+
+    def schedule(self, sender, search_target, mx, devices):
+        key = (sender, search_target)
+        if key in self._recent:
+            self.coalesced += 1
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('coalesced search from %s' % (sender,))
+            return False
+
+        self.answered += 1
+        self._recent.add(key)
+        self._loop.call_later(max(self._window, mx), self._recent.discard,
+                              key)
+
+        address = self._addresses.address_for(sender[0])
+        slots = min(self.SLOTS, len(devices))
+        for slot in range(slots):
+            self._loop.call_later(random.uniform(0, mx), self._respond,
+                                  sender, search_target, address,
+                                  devices[slot::slots])
 
-        if 'poll' in dir(select):
-            self._poller = select.poll()
+        return True
 
-        self._devices = {}
+    def _respond(self, dest, search_target, address, devices):
+        self._sender.send([(device.search_response(search_target, address),
+                            dest) for device in devices])
 
-    def add(self, device, file_no=None):
-        if not file_no:
-            file_no = device.fileno()
 
-        if self._poller:
-            self._poller.register(file_no, select.POLLIN)
+class sender_filter(object):
+    # Decides from the source address alone whether a packet is worth
+    # looking at. Entries may be single addresses or CIDR networks; the
+    # verdict for each address is remembered so the networks are only
+    # walked the first time a host is heard from.
+    MAX_CACHED = 4096
 
-        self._devices[file_no] = device
+    def __init__(self, deny=FILTER, allow=SSDP_ALLOW):
+        self._deny_hosts, self._deny_nets = self._compile(deny)
+        if allow is None:
+            self._allow_hosts, self._allow_nets = None, None
+        else:
+            self._allow_hosts, self._allow_nets = self._compile(allow)
+        self._verdicts = {}
+
+    @staticmethod
+    def _compile(entries):
+        hosts = set()
+        nets = []
+        for entry in entries:
+            if '/' in entry:
+                nets.append(ipaddress.ip_network(entry, strict=False))
+            else:
+                hosts.add(entry)
 
-    def remove(self, device, file_no=None):
-        if not file_no:
-            file_no = device.fileno()
+        return hosts, nets
 
-        if self._poller:
-            self._poller.unregister(file_no)
+    def accepts(self, ip):
+        verdict = self._verdicts.get(ip)
+        if verdict is None:
+            if len(self._verdicts) >= self.MAX_CACHED:
+                self._verdicts.clear()
+            verdict = self._verdicts[ip] = self._check(ip)
 
-        del(self._devices[file_no])
+        return verdict
+
+    def _check(self, ip):
+        if ip in self._deny_hosts:
+            return False
+
+        address = ipaddress.ip_address(ip)
+        if any(address in net for net in self._deny_nets):
+            return False
 
-    def poll(self, timeout=0):
-        ready = []
-        if self._poller:
-            ready = self._poller.poll(timeout)
-        elif len(self._devices) > 0:
-            (rsocks, wsocks, esocks) = select.select(self._devices.keys(),
-                                                  [], [], timeout)
-            ready = [(s, None) for s in rsocks]
+        if self._allow_hosts is None:
+            return True
 
-        for file_no in ready:
-            device = self._devices.get(file_no[0], None)
-            if device:
-                device.read(file_no[0])
+        return ip in self._allow_hosts or \
+            any(address in net for net in self._allow_nets)
 
 
 class upnp_broadcaster(object):
     # Since we have a single process managing several virtual UPnP devices,
     # we only need a single listener for UPnP broadcasts. When a matching
     # search is received, it causes each device instance to respond.
-    TIMEOUT = 0
+    #
+    # Most multicast traffic on a LAN is of no interest to us, so packets
+    # are read into one reused buffer, dropped on the sender address before
+    # the payload is looked at, and only the ST and MX headers of an
+    # M-SEARCH are ever parsed.
+    BUFFER_SIZE = 2048
+    # Datagrams handled per wakeup before yielding back to the loop
+    BATCH = 64
+    ST_RE = re.compile(br'\r\nST:[ \t]*([^\r\n]*)', re.IGNORECASE)
+    # Search target we answer -> ST we answer with
+    SEARCH_TARGETS = {b'upnp:rootdevice': 'urn:rootdevice'}
+    # Sources whose dropped packets are counted one by one; the ones
+    # heard from after that are all counted as 'other'
+    MAX_DROP_SOURCES = 256
 
     def __init__(self):
         self.devices = []
-        self.inprogress = False
+        self.ssock = None
+        self.filter = sender_filter()
+        self.interfaces = None
+        self.received = 0
+        # source address -> packets dropped
+        self.dropped = collections.Counter()
+        self._loop = None
+        self.scheduler = None
+        self.trace = None
+        self.clients = None
+        self._buffer = bytearray(self.BUFFER_SIZE)
 
     def init_socket(self):
         ok = True
         self.ip = '239.255.255.250'
         self.port = 1900
+        self.interfaces = interfaces.table()
         try:
-            # This is needed to join a multicast group
-            self.mreq = struct.pack(
-                "4sl", socket.inet_aton(self.ip), socket.INADDR_ANY)
-
             # Set up server socket
             self.ssock = socket.socket(
                 socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -113,12 +352,20 @@ class upnp_broadcaster(object):
                              (self.ip, self.port, e))
                 ok = False
 
-            try:
-                self.ssock.setsockopt(
-                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.mreq)
-            except Exception as e:
-                logger.warning('WARNING: Failed to join multicast group:{0}'.
-                             format(e))
+            # Join the group on every interface, so searches from every
+            # subnet reach us, not just those on the default route's.
+            addresses = [i.address for i in self.interfaces.interfaces]
+            joined = 0
+            for address in addresses or ['0.0.0.0']:
+                mreq = socket.inet_aton(self.ip) + socket.inet_aton(address)
+                try:
+                    self.ssock.setsockopt(
+                        socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                    joined += 1
+                except Exception as e:
+                    logger.warning('WARNING: Failed to join multicast group '
+                                   'on {0}:{1}'.format(address, e))
+            if not joined:
                 ok = False
 
         except Exception as e:
@@ -130,50 +377,78 @@ class upnp_broadcaster(object):
 
         return ok
 
-    def fileno(self):
-        return self.ssock.fileno()
+    def start(self, loop, sender, trace=None, clients=None):
+        # Without a socket (replaying a trace) datagrams are handed to
+        # datagram_received() directly. Searches from a client over its
+        # rate in `clients`, a clients.client_table, go unanswered.
+        self._loop = loop
+        self.trace = trace
+        self.clients = clients
+        self.scheduler = search_scheduler(loop, sender,
+                                          addresses=self.interfaces)
+        if self.ssock:
+            self.ssock.setblocking(False)
+            loop.add_reader(self.ssock.fileno(), self._read)
+
+    def _read(self):
+        buf = self._buffer
+        for _ in range(self.BATCH):
+            try:
+                size, sender = self.ssock.recvfrom_into(buf)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.error(e)
+                return
+
+            self.received += 1
+            if self.trace:
+                self.trace.datagram(bytes(buf[:size]), sender, self.port)
+            self.datagram_received(buf, size, sender)
+
+    def datagram_received(self, buf, size, sender):
+        ip = sender[0]
+        if not self.filter.accepts(ip):
+            if ip not in self.dropped and \
+                    len(self.dropped) >= self.MAX_DROP_SOURCES:
+                ip = 'other'
+            self.dropped[ip] += 1
+            return
 
-    def read(self, fileno):
-        data, sender = self.recvfrom(1024)
         if logger.isEnabledFor(DEBUG):
-            logger.debug('sender: {0} - data : {1}'.format(sender, data))
+            logger.debug('sender: {0} - data : {1}'.format(
+                sender, bytes(buf[:size]).decode('utf-8', 'replace')))
 
-        if sender[0] in FILTER:
-            return
-
-        if sender[0] in ALEXA:
-            logger.info(ALEXA[sender[0]])
+        if ip in ALEXA:
+            logger.info(ALEXA[ip])
 
-        if data:
-            if data.find('M-SEARCH') == 0 and not self.inprogress:
-                if data.find('upnp:rootdevice') != -1:
-                    for device in self.devices:
-                        time.sleep(0.1)
-                        device.respond_to_search(sender, 'urn:rootdevice')
-                        self.inprogress = True
-            else:
-                pass
-        else:
-            pass
+        if not buf.startswith(b'M-SEARCH'):
+            return
 
-    # Receive network data
-    def recvfrom(self, size):
-        if self.TIMEOUT:
-            self.ssock.setblocking(0)
-            ready = select.select([self.ssock], [], [], self.TIMEOUT)[0]
-        else:
-            self.ssock.setblocking(1)
-            ready = True
+        match = self.ST_RE.search(buf, 0, size)
+        if not match:
+            return
 
-        try:
-            if ready:
-                return self.ssock.recvfrom(size)
-            else:
-                return False, False
-        except Exception as e:
-            logger.error(e)
-            return False, False
+        search_target = self.SEARCH_TARGETS.get(match.group(1).strip())
+        if search_target:
+            if self.clients and not self.clients.search(ip):
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug('too many searches from %s' % ip)
+                return
+            self.scheduler.schedule(sender, search_target,
+                                    self.scheduler.mx(buf, size),
+                                    self.devices)
+
+    def close(self):
+        if self._loop and self.ssock:
+            self._loop.remove_reader(self.ssock.fileno())
+            self._loop = None
 
     def add_device(self, device):
         self.devices.append(device)
         logger.info("UPnP broadcast listener: new device registered")
+
+    def remove_device(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+            logger.info("UPnP broadcast listener: device unregistered")